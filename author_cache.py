@@ -0,0 +1,69 @@
+import collections
+import json
+import logging
+import threading
+import traceback
+
+import prawcore
+
+import chunks
+
+# what AuthorCache.get returns for names that aren't cached, since None is a cached answer
+missing = object()
+
+class AuthorCache:
+    # maps redditor names to ids. suspended or deleted accounts are cached as None, so they are
+    # not looked up again. the least recently used names are evicted past `max_size` entries.
+    def __init__(self, filename, max_size=200000):
+        self.filename = filename
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict(chunks.load_json(filename, []))
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.entries
+
+    def get(self, name):
+        # checked and read under one lock, so the name can't be evicted in between
+        with self.lock:
+            author_id = self.entries.get(name, missing)
+            if author_id is not missing:
+                self.entries.move_to_end(name)
+            return author_id
+
+    def put(self, name, author_id):
+        with self.lock:
+            self.entries[name] = author_id
+            self.entries.move_to_end(name)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def resolve(self, reddit, names):
+        # look up every distinct name that isn't cached yet, once. returns {name: id or None}.
+        resolved = dict()
+        for name in set(names):
+            author_id = self.get(name)
+            if author_id is missing:
+                author_id = None
+                try:
+                    redditor = reddit.redditor(name)
+                    # suspended accounts come back without an id
+                    author_id = getattr(redditor, "id", None)
+                    self.put(name, author_id)
+                except (prawcore.NotFound, prawcore.Forbidden):
+                    self.put(name, None)
+                except Exception as _:
+                    # anything else may be transient, so don't remember it
+                    logging.error(traceback.format_exc())
+
+            # kept here rather than read back from the cache, which may have evicted it by now
+            resolved[name] = author_id
+
+        return resolved
+
+    def save(self):
+        with self.lock:
+            # a list of pairs keeps the recency order across runs
+            text = json.dumps(list(self.entries.items()), ensure_ascii=False)
+        chunks.write_atomic(self.filename, text)
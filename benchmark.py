@@ -0,0 +1,357 @@
+import argparse
+import bisect
+import collections
+import contextlib
+import csv
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import chunks
+import http_client
+import praw_crawl
+import praw_process
+import pushshift
+from reddit_pool import RedditPool
+
+# every benchmark crawls the same synthetic subreddit between these dates
+after = "2016-01-01T00:00:00"
+before = "2016-12-31T23:59:59"
+
+words = ["dao", "ethereum", "gas", "fork", "token", "wallet", "miner", "block", "contract", "hash"]
+
+def make_posts(count, seed=0):
+    # posts spread over the benchmark range, several of them sharing a second like real listings do
+    rng = random.Random(seed)
+    start_time = int(datetime.strptime(after, '%Y-%m-%dT%H:%M:%S').timestamp())
+    end_time = int(datetime.strptime(before, '%Y-%m-%dT%H:%M:%S').timestamp())
+    times = sorted(rng.randrange(start_time + 1, end_time) for _ in range(count))
+
+    posts = []
+    for i, created_utc in enumerate(times):
+        post_id = f"b{i:06x}"
+        selftext = " ".join(rng.choices(words, k=rng.randrange(0, 60)))
+        posts.append({
+            "id": post_id,
+            "created_utc": created_utc,
+            "title": " ".join(rng.sample(words, 3)),
+            "selftext": selftext,
+            "selftext_html": f"<div class=\"md\"><p>{selftext}</p></div>",
+            "is_self": True,
+            "url": f"https://www.reddit.com/r/bench/comments/{post_id}/",
+            "author": f"author{rng.randrange(500)}",
+            "num_comments": 0,
+            "score": rng.randrange(100),
+            "full_link": f"https://www.reddit.com/r/bench/comments/{post_id}/",
+            "subreddit": "bench",
+        })
+    return posts
+
+class PushshiftStandIn:
+    # a local stand-in for the pushshift submission search. every request waits `latency` seconds,
+    # fails with a 500 with probability `error_rate`, and is throttled with a 429 with probability `throttle_rate`.
+    def __init__(self, posts, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=0, max_size=100):
+        self.posts = posts
+        self.times = [post["created_utc"] for post in posts]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_size = max_size
+        self.stats = {"requests": 0, "errors": 0, "throttled": 0}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def search(self, params):
+        # "after" and "before" are exclusive, like pushshift's
+        start = bisect.bisect_right(self.times, int(params.get("after", 0)))
+        end = bisect.bisect_left(self.times, int(params.get("before", 2 ** 62)))
+        posts = self.posts[start:end]
+        if params.get("q"):
+            posts = [post for post in posts if params["q"] in post["title"] or params["q"] in post["selftext"]]
+
+        size = min(int(params.get("size", 25)), self.max_size)
+        return {"data": posts[:size], "metadata": {"total_results": len(posts)}}
+
+    def respond(self, params):
+        # returns (status, headers, body)
+        time.sleep(self.latency)
+        with self.lock:
+            self.stats["requests"] += 1
+            roll = random.random()
+            if roll < self.throttle_rate:
+                self.stats["throttled"] += 1
+                return 429, {"Retry-After": str(self.retry_after)}, b""
+            if roll < self.throttle_rate + self.error_rate:
+                self.stats["errors"] += 1
+                return 500, {}, b""
+
+        return 200, {"Content-Type": "application/json"}, json.dumps(self.search(params)).encode()
+
+    def start(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                status, headers, body = stand_in.respond(params)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}/reddit/search/submission"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FakeAuthor:
+    def __init__(self, name):
+        self.name = name
+
+class FakeComment:
+    # carries the attributes comment_record reads from a PRAW comment
+    def __init__(self, submission_id, number, parent_id, rng):
+        self.id = f"{submission_id}c{number:x}"
+        self.author = FakeAuthor(f"author{rng.randrange(500)}")
+        self.author_fullname = f"t2_{self.author.name}"
+        self.body = " ".join(rng.choices(words, k=rng.randrange(1, 40)))
+        self.body_html = f"<div class=\"md\"><p>{self.body}</p></div>"
+        self.created_utc = 1451606400.0 + number
+        self.distinguished = None
+        self.edited = False
+        self.is_submitter = False
+        self.link_id = f"t3_{submission_id}"
+        self.parent_id = parent_id
+        self.permalink = f"/r/bench/comments/{submission_id}/_/{self.id}/"
+        self.saved = False
+        self.score = rng.randrange(-5, 50)
+        self.stickied = False
+        self.subreddit_id = "t5_bench"
+        self.replies = []
+
+class FakeMoreComments:
+    # a "load more comments" link hiding `comments`. expanding it costs one request.
+    def __init__(self, comments):
+        self.comments = comments
+
+class FakeCommentForest:
+    def __init__(self, items, latency):
+        self.items = items
+        self.latency = latency
+
+    def replace_more(self, limit=None):
+        # expand every "load more comments" link, one request each, like PRAW does with limit=None
+        queue = [self.items]
+        while queue:
+            items = queue.pop()
+            expanded = []
+            for item in items:
+                if isinstance(item, FakeMoreComments):
+                    time.sleep(self.latency)
+                    expanded.extend(item.comments)
+                else:
+                    expanded.append(item)
+            items[:] = expanded
+            queue.extend(comment.replies for comment in items)
+        return []
+
+    def list(self):
+        # breadth first, like CommentForest.list
+        comments = collections.deque(self.items)
+        listed = []
+        while comments:
+            comment = comments.popleft()
+            listed.append(comment)
+            comments.extend(comment.replies)
+        return listed
+
+class FakeSubmission:
+    def __init__(self, submission_id, depth, breadth, more_fanout, latency):
+        # every comment above `depth` has `breadth` replies, and every reply list ends with a
+        # "load more comments" link hiding `more_fanout` more replies without replies of their own
+        rng = random.Random(submission_id)
+        number = 0
+
+        def replies(parent_id, level):
+            nonlocal number
+            items = []
+            for _ in range(breadth):
+                number += 1
+                comment = FakeComment(submission_id, number, parent_id, rng)
+                if level < depth:
+                    comment.replies = replies(f"t1_{comment.id}", level + 1)
+                items.append(comment)
+
+            if more_fanout > 0:
+                hidden = []
+                for _ in range(more_fanout):
+                    number += 1
+                    hidden.append(FakeComment(submission_id, number, parent_id, rng))
+                items.append(FakeMoreComments(hidden))
+            return items
+
+        self.id = submission_id
+        self.comments = FakeCommentForest(replies(f"t3_{submission_id}", 1), latency)
+        self.score = rng.randrange(100)
+        self.upvote_ratio = 0.9
+        self.num_comments = number
+
+class FakeReddit:
+    # the part of praw.Reddit the crawler uses. fetching a submission costs one request.
+    def __init__(self, depth=3, breadth=3, more_fanout=5, latency=0.0):
+        self.depth = depth
+        self.breadth = breadth
+        self.more_fanout = more_fanout
+        self.latency = latency
+
+    def submission(self, submission_id):
+        time.sleep(self.latency)
+        return FakeSubmission(submission_id, self.depth, self.breadth, self.more_fanout, self.latency)
+
+def peak_rss():
+    # peak resident set size of this process in MB. ru_maxrss is in bytes on macOS and KB elsewhere.
+    if resource is None:
+        return float("nan")
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+def measure(stage, *args):
+    # stages run in a fresh process each, so every stage reports its own peak rss
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        count, seconds = stage(*args)
+    return count, seconds, peak_rss()
+
+def count_records(dirname, name):
+    return sum(1 for _, filename in chunks.iter_chunks(dirname, name) for _ in chunks.iter_records(filename))
+
+def bench_cache_posts(url, root, shards, workers, rate, backoff):
+    pushshift.submission_url = url
+    http_client.configure(rate=rate, backoff=backoff, default_concurrency=max(shards, workers or 0, 1))
+    start = time.perf_counter()
+    pushshift.cache_posts("all", after, before, "bench", target_dir=f"{root}/pushshift", shards=shards, workers=workers)
+    seconds = time.perf_counter() - start
+    return sum(1 for _ in chunks.iter_chunks(f"{root}/pushshift/posts/all", "post{}")), seconds
+
+def bench_crawl_comments(root, workers, output_format, depth, breadth, more_fanout, latency):
+    reddits = RedditPool([FakeReddit(depth, breadth, more_fanout, latency) for _ in range(workers)])
+    start = time.perf_counter()
+    praw_crawl.crawl_comments(reddits, f"{root}/pushshift/posts/all", output_format)
+    seconds = time.perf_counter() - start
+    return count_records(f"{root}/praw/comments/all", "post{}_comment"), seconds
+
+def bench_process(kind, root, jobs):
+    os.makedirs(f"{root}/results", exist_ok=True)
+    start = time.perf_counter()
+    if kind == "posts":
+        praw_process.process_posts(f"{root}/pushshift/posts/all", f"{root}/results", jobs)
+    else:
+        praw_process.process_comments(f"{root}/praw/comments/all", f"{root}/results", jobs)
+    seconds = time.perf_counter() - start
+    with open(f"{root}/results/{kind}.csv", newline='') as f:
+        return sum(1 for _ in csv.reader(f)) - 1, seconds
+
+def bench_nested_map(root):
+    # only building the maps is timed, not reading the chunks
+    threads = []
+    for _, filename in chunks.iter_chunks(f"{root}/praw/comments/all", "post{}_comment"):
+        threads.extend(praw_process.iter_threads(chunks.iter_records(filename)))
+
+    start = time.perf_counter()
+    for thread in threads:
+        praw_process.make_nested_map(thread)
+    return sum(len(thread) for thread in threads), time.perf_counter() - start
+
+stages = {
+    "cache_posts": "pages",
+    "crawl_comments": "comments",
+    "process_posts": "rows",
+    "process_comments": "rows",
+    "make_nested_map": "comments",
+}
+
+def run_benchmark(args, root):
+    posts = make_posts(args.posts)
+    stand_in = PushshiftStandIn(posts, args.page_latency, args.error_rate, args.throttle_rate, args.retry_after, args.max_size)
+    url = stand_in.start()
+
+    calls = {
+        "cache_posts": (bench_cache_posts, url, root, args.shards, args.workers, args.rate, args.backoff),
+        "crawl_comments": (bench_crawl_comments, root, args.workers or 1, args.format, args.depth, args.breadth, args.more_fanout, args.reddit_latency),
+        "process_posts": (bench_process, "posts", root, args.jobs),
+        "process_comments": (bench_process, "comments", root, args.jobs),
+        "make_nested_map": (bench_nested_map, root),
+    }
+
+    results = dict()
+    try:
+        for stage in stages:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                count, seconds, rss = executor.submit(measure, *calls[stage]).result()
+            results[stage] = {"unit": stages[stage], "count": count, "seconds": seconds, "rate": count / seconds if seconds else 0.0, "peak_rss_mb": rss}
+            print(f"{stage:<17} {count:>9} {stages[stage]:<8} {seconds:8.2f}s {results[stage]['rate']:12.1f} {stages[stage]}/s   peak rss {rss:8.1f} MB")
+    finally:
+        stand_in.stop()
+
+    print(f"pushshift stand-in: {stand_in.stats['requests']} requests, {stand_in.stats['errors']} errors, {stand_in.stats['throttled']} throttled")
+    results["pushshift"] = stand_in.stats
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", help='Number of synthetic posts. 5000 by default', type=int, default=5000)
+    parser.add_argument("--page-latency", help='Seconds every pushshift request takes. 0 by default', type=float, default=0.0)
+    parser.add_argument("--error-rate", help='Share of pushshift requests failing with a 500. 0 by default', type=float, default=0.0)
+    parser.add_argument("--throttle-rate", help='Share of pushshift requests throttled with a 429. 0 by default', type=float, default=0.0)
+    parser.add_argument("--retry-after", help='Retry-After of throttled requests, in seconds. 0 by default', type=int, default=0)
+    parser.add_argument("--max-size", help='Most results pushshift returns per page. 100 by default', type=int, default=100)
+    parser.add_argument("--rate", help='Maximum number of requests per second sent to pushshift. 1000 by default', type=float, default=1000.0)
+    parser.add_argument("--backoff", help='Base backoff in seconds after a failed pushshift request. 0.05 by default', type=float, default=0.05)
+    parser.add_argument("--shards", help='Time windows pushshift is paged through concurrently. 1 by default', type=int, default=1)
+    parser.add_argument("--workers", help='Concurrent pushshift windows and reddit workers. 1 by default', type=int)
+    parser.add_argument("--depth", help='Depth of every synthetic comment tree. 3 by default', type=int, default=3)
+    parser.add_argument("--breadth", help='Replies of every comment above the deepest level. 3 by default', type=int, default=3)
+    parser.add_argument("--more-fanout", help='Comments hidden behind the "load more comments" link of every reply list. 0 for none. 5 by default', type=int, default=5)
+    parser.add_argument("--reddit-latency", help='Seconds every reddit request takes, including every "load more comments" expansion. 0 by default', type=float, default=0.0)
+    parser.add_argument("--format", help='Chunk format written by praw_crawl. json by default', choices=praw_crawl.chunk_formats.keys(), default="json")
+    parser.add_argument("--jobs", help='Processes used by praw_process. 1 by default', type=int, default=1)
+    parser.add_argument("--output", help='Also write the results to this json file, to compare runs. ex> ./benchmark.json')
+    parser.add_argument("--keep", help='Keep the benchmark cache in this directory instead of a temporary one')
+    args = parser.parse_args()
+
+    root = args.keep or tempfile.mkdtemp(prefix="benchmark-")
+    if os.path.exists(root) and os.listdir(root):
+        print(f"Error: {root} is not empty", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        results = run_benchmark(args, root)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(root)
+
+    if args.output is not None:
+        chunks.save_json(args.output, {"arguments": vars(args), "results": results})
@@ -0,0 +1,143 @@
+import gzip
+import json
+import os
+import os.path
+import time
+
+import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compressed chunks keep their format's extension and add the compression's, ex> post1.json.gz
+compression_suffixes = {"gzip": ".gz", "zstd": ".zst"}
+
+# how new chunks are written. set by configure()
+compression = None
+dropped_fields = ()
+
+def configure(compress=None, drop_fields=()):
+    # compress: None, "gzip" or "zstd". drop_fields: fields removed from every record written to a chunk.
+    global compression, dropped_fields
+    if compress == "zstd" and zstandard is None:
+        raise RuntimeError("zstd compression needs the zstandard package. pip install zstandard")
+    compression = compress
+    dropped_fields = tuple(drop_fields)
+
+def compressed(filename):
+    # the name a new chunk is written under with the configured compression
+    return filename + compression_suffixes[compression] if compression is not None else filename
+
+def split_extension(filename):
+    # "dir/post1.json.gz" -> ("dir/post1", ".json.gz")
+    for suffix in ("",) + tuple(compression_suffixes.values()):
+        for extension in chunk_extensions:
+            if filename.endswith(extension + suffix):
+                return filename[:-len(extension + suffix)], extension + suffix
+    return os.path.splitext(filename)
+
+def is_jsonl(filename):
+    return split_extension(filename)[1].startswith(".jsonl")
+
+def open_chunk(filename, mode="r", name=None):
+    # open a chunk in text mode, compressed or not depending on its name. `name` is the name to go by
+    # when it differs from `filename`, as for temporary files.
+    name = name or filename
+    if name.endswith(".gz"):
+        return gzip.open(filename, mode + "t", compresslevel=6, encoding="utf-8")
+    if name.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"{name} is compressed with zstd, which needs the zstandard package. pip install zstandard")
+        return zstandard.open(filename, mode + "t", encoding="utf-8")
+    return open(filename, mode, encoding="utf-8")
+
+def project(record):
+    if not dropped_fields:
+        return record
+    return {key: value for key, value in record.items() if key not in dropped_fields}
+
+def fsync(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_atomic(filename, text):
+    # write to a temporary file first, so a crash never leaves a truncated file behind
+    tmp_filename = f"{filename}.tmp"
+    with open_chunk(tmp_filename, "w", filename) as f:
+        f.write(text)
+    fsync(tmp_filename)
+    os.replace(tmp_filename, filename)
+
+def write_chunk(filename, text):
+    # only chunk writes are timed, not manifests and the other files saved along the way
+    started = time.monotonic()
+    write_atomic(filename, text)
+    metrics.observe("chunk_write_seconds", time.monotonic() - started)
+
+def load_json(filename, default=None):
+    if not os.path.exists(filename):
+        return default
+
+    with open_chunk(filename) as f:
+        return json.loads(f.read())
+
+def save_json(filename, data):
+    write_atomic(filename, json.dumps(data, indent=4, ensure_ascii=False))
+
+# chunk formats in the order they are looked up
+chunk_extensions = (".jsonl", ".json")
+
+def chunk_filename(dirname, name):
+    # find chunk `name` in whichever format and compression it was written. returns None if there is no such chunk.
+    for extension in chunk_extensions:
+        for suffix in ("",) + tuple(compression_suffixes.values()):
+            filename = f"{dirname}/{name}{extension}{suffix}"
+            if os.path.exists(filename):
+                return filename
+
+    return None
+
+def iter_chunks(dirname, name):
+    # yields (number, filename) for the consecutive chunks `name.format(1)`, `name.format(2)`, ...
+    number = 1
+    filename = chunk_filename(dirname, name.format(number))
+    while filename is not None:
+        yield number, filename
+        number += 1
+        filename = chunk_filename(dirname, name.format(number))
+
+def iter_records(filename):
+    # jsonl chunks are read one line at a time. json chunks are either a pushshift
+    # response with a "data" list, or a plain list of records.
+    if is_jsonl(filename):
+        with open_chunk(filename) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+
+    with open_chunk(filename) as f:
+        data = json.loads(f.read())
+
+    yield from data["data"] if isinstance(data, dict) else data
+
+def write_records(filename, records, wrapper=None):
+    # atomically write records in the format and compression given by the extension. json chunks are
+    # written as a plain list, or as `wrapper` with its "data" replaced when one is given.
+    started = time.monotonic()
+    tmp_filename = f"{filename}.tmp"
+    with open_chunk(tmp_filename, "w", filename) as f:
+        if is_jsonl(filename):
+            for record in records:
+                f.write(json.dumps(project(record), ensure_ascii=False) + "\n")
+        else:
+            records = [project(record) for record in records]
+            f.write(json.dumps(records if wrapper is None else {**wrapper, "data": records}, indent=4, ensure_ascii=False))
+    fsync(tmp_filename)
+    os.replace(tmp_filename, filename)
+    metrics.observe("chunk_write_seconds", time.monotonic() - started)
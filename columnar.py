@@ -0,0 +1,189 @@
+import itertools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+from thread_index import ThreadIndex
+
+# parquet and arrow need pyarrow. npz only needs numpy.
+columnar_formats = ("parquet", "arrow", "npz")
+
+# columns holding free text. they are kept as python strings instead of fixed width numpy strings,
+# which would pad every value to the longest one.
+text_columns = ("title", "contents")
+
+comments_prefix = "https://www.reddit.com/comments/"
+
+class AuthorCodes:
+    # authors are written as integer codes. the codes are the same in every batch and are resolved
+    # with the authors table written next to the output.
+    def __init__(self):
+        self.codes = dict()
+        self.ids = []
+
+    def encode(self, names, ids=None):
+        ids = ids or itertools.repeat(None)
+        codes = np.empty(len(names), dtype=np.int32)
+        for i, (name, author_id) in enumerate(zip(names, ids)):
+            code = self.codes.get(name)
+            if code is None:
+                code = self.codes[name] = len(self.codes)
+                self.ids.append(author_id)
+            codes[i] = code
+        return codes
+
+    def columns(self):
+        return {
+            "author_code": np.arange(len(self.codes), dtype=np.int32),
+            "author_name": np.array(list(self.codes), dtype=str),
+            "author_id": np.array([author_id or "" for author_id in self.ids], dtype=str),
+        }
+
+def post_batch(posts, contents, start, authors):
+    # the columns of a chunk of posts, numbered from `start`. `contents` are the resolved contents of the posts.
+    return {
+        "num_post": np.arange(start, start + len(posts), dtype=np.int64),
+        "post_id": np.array([post["id"] for post in posts], dtype=str),
+        "title": [post["title"] for post in posts],
+        "author": authors.encode([post["author"] for post in posts]),
+        "date": np.array([post["created_utc"] for post in posts], dtype=np.int64).astype("datetime64[s]"),
+        "contents": contents,
+        "comments": np.array([post["num_comments"] for post in posts], dtype=np.int64),
+        "votes": np.array([post["score"] for post in posts], dtype=np.int64),
+        "link": np.array([post["full_link"] for post in posts], dtype=str),
+        "upvote_ratio": np.array([post["upvote_ratio"] for post in posts], dtype=np.float64),
+    }
+
+def strip_prefix(fullnames):
+    # "t3_abc" -> "abc". partition fails on empty arrays.
+    return np.char.partition(fullnames, "_")[:, 2] if len(fullnames) else fullnames
+
+def comment_batch(comments, start, authors):
+    # the columns of a chunk of comments, numbered from `start`. links are built for the whole chunk at once.
+    depth, root, replies, size, score = [], [], [], [], []
+    for _, thread in itertools.groupby(comments, key=lambda comment: comment["link_id"]):
+        thread = list(thread)
+        tindex = ThreadIndex(thread)
+        for comment in thread:
+            depth.append(tindex.depth[comment["id"]] + 1)
+            root.append(tindex.root[comment["id"]])
+            replies.append(tindex.replies[comment["id"]])
+            size.append(tindex.size[comment["id"]])
+            score.append(tindex.score[comment["id"]])
+
+    comment_ids = np.array([comment["id"] for comment in comments], dtype=str)
+    link_ids = np.array([comment["link_id"] for comment in comments], dtype=str)
+    parent_ids = np.array([comment["parent_id"] for comment in comments], dtype=str)
+    post_ids = strip_prefix(link_ids)
+    reply_ids = strip_prefix(parent_ids)
+
+    post_links = np.char.add(comments_prefix, post_ids)
+    thread_links = np.char.add(post_links, "/comment/")
+    return {
+        "num_comment": np.arange(start, start + len(comments), dtype=np.int64),
+        "author": authors.encode([comment["author_name"] for comment in comments], [comment["author_id"] for comment in comments]),
+        "comment_id": comment_ids,
+        "date": np.array([comment["created_utc"] for comment in comments], dtype=np.int64).astype("datetime64[s]"),
+        "contents": [comment["body"] for comment in comments],
+        "votes": np.array([comment["score"] for comment in comments], dtype=np.int64),
+        "post_link": post_links,
+        "comment_link": np.char.add(thread_links, comment_ids),
+        "reply_to": np.where(link_ids != parent_ids, np.char.add(thread_links, reply_ids), ""),
+        "nested_level": np.array(depth, dtype=np.int32),
+        "root_id": np.array(root, dtype=str),
+        "num_replies": np.array(replies, dtype=np.int32),
+        "subtree_size": np.array(size, dtype=np.int32),
+        "subtree_score": np.array(score, dtype=np.int64),
+    }
+
+def to_arrow(columns):
+    arrays = dict()
+    for name, column in columns.items():
+        if name in text_columns:
+            arrays[name] = pa.array(column, type=pa.string())
+        elif name == "date":
+            arrays[name] = pa.array(column, type=pa.timestamp("s", tz="UTC"))
+        elif column.dtype.kind == "U":
+            arrays[name] = pa.array(column, type=pa.string())
+        else:
+            arrays[name] = pa.array(column)
+    return pa.table(arrays)
+
+def encode_strings(values):
+    # utf-8 bytes of every value back to back, and where each value starts. value i is data[offsets[i]:offsets[i + 1]].
+    encoded = [value.encode() for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def decode_strings(data, offsets):
+    data = data.tobytes()
+    return [data[offsets[i]:offsets[i + 1]].decode() for i in range(len(offsets) - 1)]
+
+def load_npz(filename):
+    # the columns of an npz export, with text columns decoded back to lists of strings
+    columns = dict()
+    with np.load(filename) as npz:
+        for name in npz.files:
+            if name.endswith(".offsets"):
+                continue
+            if name.endswith(".data"):
+                column = name[:-len(".data")]
+                columns[column] = decode_strings(npz[name], npz[f"{column}.offsets"])
+            else:
+                columns[name] = npz[name]
+    return columns
+
+class ColumnarWriter:
+    # parquet gets a row group and arrow a record batch per chunk, as the chunks are converted.
+    # npz files can't be appended to, so its batches are concatenated when the writer is closed.
+    def __init__(self, filename, output_format):
+        if np is None:
+            raise RuntimeError("Columnar export needs numpy. pip install numpy")
+        if output_format != "npz" and pa is None:
+            raise RuntimeError(f"{output_format} export needs pyarrow. pip install pyarrow")
+
+        self.filename = filename
+        self.output_format = output_format
+        self.writer = None
+        self.batches = []
+
+    def write(self, columns):
+        if self.output_format == "npz":
+            self.batches.append(columns)
+            return
+
+        table = to_arrow(columns)
+        if self.writer is None:
+            if self.output_format == "parquet":
+                self.writer = pyarrow.parquet.ParquetWriter(self.filename, table.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.filename, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.output_format != "npz":
+            if self.writer is not None:
+                self.writer.close()
+            return
+
+        arrays = dict()
+        for name in self.batches[0] if self.batches else []:
+            if name in text_columns:
+                arrays[f"{name}.data"], arrays[f"{name}.offsets"] = encode_strings(itertools.chain.from_iterable(batch[name] for batch in self.batches))
+            else:
+                arrays[name] = np.concatenate([batch[name] for batch in self.batches])
+        np.savez(self.filename, **arrays)
+
+def write_table(columns, filename, output_format):
+    writer = ColumnarWriter(filename, output_format)
+    writer.write(columns)
+    writer.close()
@@ -0,0 +1,142 @@
+import email.utils
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# status codes worth retrying. anything else is either a success or our own mistake.
+retry_statuses = {429, 500, 502, 503, 504, 520, 521, 522, 524}
+
+class TokenBucket:
+    # allows `rate` requests per second on average, with bursts of up to `capacity` requests
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # block until a token is available. returns how long we had to wait.
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class Client:
+    def __init__(self, rate=1.0, burst=None, max_retries=6, backoff=2.0, max_backoff=120.0,
+                 concurrency=None, default_concurrency=8, timeout=60):
+        # limits are keyed by endpoint path, ex> {"/reddit/search/comment": 2}
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.semaphores = dict()
+        self.semaphores_lock = threading.Lock()
+
+        # keep one pooled connection around for every request that may be in flight
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max([default_concurrency, *self.concurrency.values()]))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+    def endpoint_semaphore(self, url):
+        path = urlparse(url).path
+        with self.semaphores_lock:
+            if path not in self.semaphores:
+                self.semaphores[path] = threading.BoundedSemaphore(self.concurrency.get(path, self.default_concurrency))
+            return self.semaphores[path]
+
+    def retry_delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                return retry_after
+
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, url, params=None):
+        endpoint = urlparse(url).path
+        attempt = 0
+        while True:
+            with self.endpoint_semaphore(url):
+                metrics.inc("rate_limit_wait_seconds_total", self.bucket.acquire(), endpoint=endpoint)
+                started = time.monotonic()
+                try:
+                    response = self.session.get(url, params=params, timeout=self.timeout)
+                except (requests.ConnectionError, requests.Timeout):
+                    metrics.inc("http_connection_errors_total", endpoint=endpoint)
+                    if attempt >= self.max_retries:
+                        raise
+                    response = None
+                metrics.observe("http_request_seconds", time.monotonic() - started, endpoint=endpoint)
+
+            if response is not None:
+                metrics.inc("http_responses_total", endpoint=endpoint, status=response.status_code)
+                metrics.inc("http_received_bytes_total", len(response.content), endpoint=endpoint)
+
+            if response is not None and response.status_code not in retry_statuses:
+                response.raise_for_status()
+                return response
+
+            if attempt >= self.max_retries:
+                response.raise_for_status()
+
+            delay = self.retry_delay(attempt, response)
+            metrics.inc("http_retries_total", endpoint=endpoint)
+            metrics.inc("http_retry_wait_seconds_total", delay, endpoint=endpoint)
+            time.sleep(delay)
+            attempt += 1
+
+    def get_json(self, url, params=None):
+        return self.get(url, params).json()
+
+shared = None
+shared_lock = threading.Lock()
+
+def configure(**kwargs):
+    # replace the client shared by every script. call this before any request is made.
+    global shared
+    with shared_lock:
+        shared = Client(**kwargs)
+    return shared
+
+def get_client():
+    global shared
+    with shared_lock:
+        if shared is None:
+            shared = Client()
+        return shared
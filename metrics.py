@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+import time
+
+# upper bounds of the latency histogram buckets, in seconds
+latency_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+class Histogram:
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+class Stage:
+    # how far a stage is, how fast it goes and when it is expected to finish
+    def __init__(self):
+        self.started = time.monotonic()
+        self.done = 0
+        self.total = None
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(0.0, (self.total - self.done) / rate)
+        return {"done": self.done, "total": self.total, "elapsed_seconds": elapsed, "rate_per_second": rate, "eta_seconds": eta}
+
+class Metrics:
+    # counters, latency histograms and stage progress, keyed by name and labels. safe to update from every thread.
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+        self.stages = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def progress(self, stage, done=None, total=None, advance=0):
+        # set how many units of `stage` are done, or advance it by `advance`. `total` enables the ETA.
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Stage()
+            if done is not None:
+                self.stages[stage].done = done
+            self.stages[stage].done += advance
+            if total is not None:
+                self.stages[stage].total = total
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "time": time.time(),
+                "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.counters.items()],
+                "histograms": [{
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": {str(bound): count for bound, count in histogram.cumulative()},
+                } for (name, labels), histogram in self.histograms.items()],
+                "stages": {stage: progress.snapshot() for stage, progress in self.stages.items()},
+            }
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (counter, labels), value in self.counters.items():
+                    if counter == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (histogram_name, labels), histogram in self.histograms.items():
+                    if histogram_name != name:
+                        continue
+                    for bound, count in histogram.cumulative():
+                        lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {histogram.count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+            snapshots = {stage: progress.snapshot() for stage, progress in self.stages.items()}
+
+        for field, name in (("done", "stage_done"), ("total", "stage_total"), ("rate_per_second", "stage_rate_per_second"), ("eta_seconds", "stage_eta_seconds")):
+            lines.append(f"# TYPE {name} gauge")
+            for stage, snapshot in snapshots.items():
+                if snapshot[field] is not None:
+                    lines.append(f'{name}{{stage="{stage}"}} {snapshot[field]}')
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        # .prom and .txt files get the Prometheus text format, anything else json
+        if filename.endswith((".prom", ".txt")):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_json(), indent=4)
+
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "w") as f:
+            f.write(text)
+        os.replace(tmp_filename, filename)
+
+# the registry every script records to
+registry = Metrics()
+
+inc = registry.inc
+observe = registry.observe
+progress = registry.progress
+
+class Exporter:
+    # writes the registry to `filename` every `interval` seconds, and once more when stopped
+    def __init__(self, filename, interval=10.0):
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            registry.write(self.filename)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        registry.write(self.filename)
+
+def start_export(filename, interval=10.0):
+    # returns None when there is nowhere to export to, so scripts can pass their --metrics-file as is
+    if filename is None:
+        return None
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    return Exporter(filename, interval).start()
@@ -0,0 +1,181 @@
+import argparse
+import csv
+import os
+import os.path
+import queue
+import sys
+import threading
+from datetime import datetime
+
+import http_client
+import praw_process
+from author_cache import AuthorCache
+from praw_crawl import crawl_submission
+from pushshift import iter_pages, page_size, submission_url
+from reddit_pool import make_reddit_pool
+
+# pushshift paging, comment crawling and csv writing run at the same time, connected by bounded queues.
+# a stage that runs ahead blocks on a full queue, so memory stays flat and the total time is
+# close to that of the slowest stage. submissions waiting to be written in order count too, so
+# the number of posts between paging and writing is bounded end to end.
+
+finished = object()
+
+class Stopped(Exception):
+    pass
+
+def put(q, item, stop):
+    # block while the queue is full, but give up once another stage has failed
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+    raise Stopped()
+
+def get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            pass
+    raise Stopped()
+
+def acquire(slots, stop):
+    while not stop.is_set():
+        if slots.acquire(timeout=1):
+            return
+    raise Stopped()
+
+def page_posts(params, start_time, end_time, posts, in_flight, workers, stop):
+    seq = 0
+    for page, _ in iter_pages(submission_url, params, start_time, end_time):
+        for post in page["data"]:
+            # the slot is released once the post's rows are written
+            acquire(in_flight, stop)
+            put(posts, (seq, post), stop)
+            seq += 1
+
+    for _ in range(workers):
+        put(posts, finished, stop)
+
+def crawl_posts(reddits, authors, posts, crawled, stop):
+    while True:
+        item = get(posts, stop)
+        if item is finished:
+            put(crawled, finished, stop)
+            return
+
+        seq, post = item
+        comments = crawl_submission(reddits, post, authors)
+        put(crawled, (seq, post, comments), stop)
+
+def write_rows(output_dir, crawled, in_flight, workers, stop):
+    with open(f"{output_dir}/posts.csv", "w", newline='') as posts_file, open(f"{output_dir}/comments.csv", "w", newline='') as comments_file:
+        post_writer = csv.DictWriter(posts_file, fieldnames=praw_process.post_fieldnames, quoting=csv.QUOTE_MINIMAL)
+        comment_writer = csv.DictWriter(comments_file, fieldnames=praw_process.comment_fieldnames, quoting=csv.QUOTE_MINIMAL)
+        post_writer.writeheader()
+        comment_writer.writeheader()
+
+        # submissions finish out of order. rows are written in pushshift's order, so numbering is stable.
+        pending = dict()
+        next_seq = 0
+        comment_index = 1
+        remaining = workers
+        while remaining > 0:
+            item = get(crawled, stop)
+            if item is finished:
+                remaining -= 1
+                continue
+
+            seq, post, comments = item
+            pending[seq] = (post, comments)
+            while next_seq in pending:
+                post, comments = pending.pop(next_seq)
+                post_writer.writerow(praw_process.post_row(post, next_seq + 1))
+                for thread in praw_process.iter_threads(comments):
+                    comment_writer.writerows(praw_process.thread_rows(thread, comment_index))
+                    comment_index += len(thread)
+                posts_file.flush()
+                comments_file.flush()
+                in_flight.release()
+                next_seq += 1
+                print(f"{next_seq:7} posts, {comment_index - 1:9} comments written.", end="\r")
+
+def run_pipeline(keyword, after, before, subreddit, reddits, output_dir="./results", authors_filename="./cache/praw/authors.json", queue_size=1000):
+    start_time = int(datetime.strptime(after, '%Y-%m-%dT%H:%M:%S').timestamp())
+    end_time = int(datetime.strptime(before, '%Y-%m-%dT%H:%M:%S').timestamp())
+    params = {
+        "q": "" if keyword == "all" else keyword,
+        "subreddit": subreddit,
+        "sort": "asc",
+        "sort_type": "created_utc",
+        "size": page_size,
+    }
+
+    for dirname in (output_dir, os.path.dirname(authors_filename)):
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    authors = AuthorCache(authors_filename)
+    posts = queue.Queue(queue_size)
+    crawled = queue.Queue(queue_size)
+    # a slow submission can't make the writer buffer more than queue_size finished ones behind it
+    in_flight = threading.BoundedSemaphore(queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def stage(target, *args):
+        try:
+            target(*args, stop)
+        except Stopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    workers = len(reddits)
+    threads = [
+        threading.Thread(target=stage, args=(page_posts, params, start_time, end_time, posts, in_flight, workers)),
+        *(threading.Thread(target=stage, args=(crawl_posts, reddits, authors, posts, crawled)) for _ in range(workers)),
+        threading.Thread(target=stage, args=(write_rows, output_dir, crawled, in_flight, workers)),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except BaseException:
+        # an interrupt only reaches the main thread, so every stage has to be told to stop
+        stop.set()
+        for thread in threads:
+            thread.join()
+        raise
+
+    authors.save()
+    if errors:
+        raise errors[0]
+
+    print(f"\nFinished. Results stored in {output_dir}/posts.csv and {output_dir}/comments.csv")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("keyword", help='Which keyword to search from pushshift. Pass "all" to search all posts. ex> "ethereum", "dao"')
+    parser.add_argument("--after", help='Posts posted after this date will be collected. format> 2016-01-01', type=lambda s: f'{s}T00:00:00', required=True)
+    parser.add_argument("--before", help='Posts posted before this date will be collected format> 2018-12-31', type=lambda s: f'{s}T23:59:59', required=True)
+    parser.add_argument("--subreddit", help='Which subreddit to search posts from. ex> "ethereum"', default="ethereum")
+    parser.add_argument("--output-dir", help='Directory to write results to. ./results by default', default="./results")
+    parser.add_argument("--workers", help='Number of submissions crawled at the same time. 1 by default', type=int, default=1)
+    parser.add_argument("--sites", help='praw.ini sites to spread the workers over. "bot" by default', nargs="+", default=["bot"])
+    parser.add_argument("--rate", help='Maximum number of requests per second sent to pushshift. 1 by default', type=float, default=1.0)
+    parser.add_argument("--queue-size", help='Maximum number of posts waiting between two stages. 1000 by default', type=int, default=1000)
+    args = parser.parse_args()
+
+    http_client.configure(rate=args.rate)
+    reddits = make_reddit_pool(args.sites, args.workers)
+    try:
+        run_pipeline(args.keyword, args.after, args.before, args.subreddit, reddits, args.output_dir, queue_size=args.queue_size)
+    except KeyboardInterrupt:
+        print("Interrupted.", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,136 @@
+import argparse
+import json
+import math
+import sys
+from datetime import datetime
+
+import http_client
+import pushshift
+import search_index
+
+def to_timestamp(date):
+    return int(datetime.strptime(date, '%Y-%m-%dT%H:%M:%S').timestamp())
+
+def load_jobs(filename):
+    # a json list of {"keyword", "subreddit", "after", "before", "target_dir"}, with dates as in pushshift.py.
+    # target_dir should end in "pushshift", since praw_crawl.py writes comments next to it in "praw".
+    with open(filename) as f:
+        jobs = json.load(f)
+
+    return [{
+        "keyword": job["keyword"],
+        "subreddit": job.get("subreddit", "ethereum"),
+        "after": f'{job["after"]}T00:00:00',
+        "before": f'{job["before"]}T23:59:59',
+        "target_dir": job.get("target_dir", "./cache/pushshift"),
+    } for job in jobs]
+
+def merge_ranges(jobs):
+    # group the jobs of a subreddit into date ranges that do not overlap
+    groups = []
+    for job in sorted(jobs, key=lambda job: to_timestamp(job["after"])):
+        after, before = to_timestamp(job["after"]), to_timestamp(job["before"])
+        if groups and after < groups[-1]["before"]:
+            groups[-1]["before"] = max(groups[-1]["before"], before)
+            groups[-1]["jobs"].append(job)
+        else:
+            groups.append({"after": after, "before": before, "jobs": [job]})
+    return groups
+
+def crawl_cost(total_results):
+    # the count query, every page and the empty page that ends the crawl
+    return math.ceil(total_results / pushshift.page_size) + 2
+
+def plan_jobs(jobs):
+    # decide, for every subreddit and range, between one scan of all posts matched locally and one query per keyword
+    destinations = {}
+    for job in jobs:
+        destination = (job["target_dir"], job["keyword"])
+        if destination in destinations:
+            print(f"Error: {job} and {destinations[destination]} would write to the same cache directory. Give one of them another target_dir.", file=sys.stderr)
+            sys.exit(1)
+        destinations[destination] = job
+
+    plans = []
+    for subreddit in sorted({job["subreddit"] for job in jobs}):
+        for group in merge_ranges([job for job in jobs if job["subreddit"] == subreddit]):
+            params = {"subreddit": subreddit}
+            totals = [
+                pushshift.fetch_total(pushshift.submission_url, {**params, "q": job["keyword"]}, to_timestamp(job["after"]), to_timestamp(job["before"]))
+                for job in group["jobs"]
+            ]
+            total = pushshift.fetch_total(pushshift.submission_url, {**params, "q": ""}, group["after"], group["before"])
+            targeted = sum(crawl_cost(count) for count in totals)
+            broad = crawl_cost(total)
+
+            plans.append({
+                "subreddit": subreddit,
+                "after": group["after"],
+                "before": group["before"],
+                "jobs": group["jobs"],
+                "scan": broad < targeted,
+                "targeted_requests": targeted,
+                "planned_requests": min(broad, targeted),
+                "probe_requests": len(totals) + 1,
+            })
+    return plans
+
+def print_plan(plans):
+    for plan in plans:
+        keywords = ", ".join(job["keyword"] for job in plan["jobs"])
+        after = datetime.fromtimestamp(plan["after"]).strftime('%Y-%m-%d')
+        before = datetime.fromtimestamp(plan["before"]).strftime('%Y-%m-%d')
+        strategy = "scan all posts and match locally" if plan["scan"] else "query every keyword"
+        print(f"r/{plan['subreddit']} {after} ~ {before} [{keywords}]: {strategy}, {plan['planned_requests']} requests instead of {plan['targeted_requests']}")
+
+    targeted = sum(plan["targeted_requests"] for plan in plans)
+    planned = sum(plan["planned_requests"] for plan in plans)
+    probes = sum(plan["probe_requests"] for plan in plans)
+    print(f"Expected requests: {planned} instead of {targeted}, {targeted - planned} saved ({probes} already spent on planning)")
+
+def run_plan(plans, index, shards=1, workers=None):
+    for plan in plans:
+        if not plan["scan"]:
+            for job in plan["jobs"]:
+                pushshift.cache_posts(job["keyword"], job["after"], job["before"], job["subreddit"], target_dir=job["target_dir"], shards=shards, workers=workers)
+            continue
+
+        # a crawl of everything covers the range in the index, and every keyword is then answered from it
+        after = datetime.fromtimestamp(plan["after"])
+        before = datetime.fromtimestamp(plan["before"])
+        scan_dir = f"./cache/pushshift/scans/{plan['subreddit']}-{after:%Y%m%d}-{before:%Y%m%d}"
+        pushshift.cache_posts("all", f"{after:%Y-%m-%dT%H:%M:%S}", f"{before:%Y-%m-%dT%H:%M:%S}", plan["subreddit"], target_dir=scan_dir, shards=shards, workers=workers, index=index)
+        for job in plan["jobs"]:
+            pushshift.cache_posts(job["keyword"], job["after"], job["before"], job["subreddit"], target_dir=job["target_dir"], shards=shards, workers=workers, index=index)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", help='A json file with a list of jobs. ex> [{"keyword": "dao", "subreddit": "ethereum", "after": "2016-01-01", "before": "2018-12-31"}]')
+    parser.add_argument("--keywords", help='Plan a job for every keyword and subreddit instead. ex> dao fork gas', nargs="+")
+    parser.add_argument("--subreddits", help='Subreddits searched for --keywords. ex> ethereum ethtrader', nargs="+", default=["ethereum"])
+    parser.add_argument("--after", help='Start of the range searched for --keywords. format> 2016-01-01')
+    parser.add_argument("--before", help='End of the range searched for --keywords. format> 2018-12-31')
+    parser.add_argument("--index", help='The index every scan is added to and keywords are matched in. ./cache/index.db by default', default="./cache/index.db")
+    parser.add_argument("--dry-run", help='Only print the plan', action="store_true")
+    parser.add_argument("--shards", help='Split the date range of every crawl into this many time windows. 1 by default', type=int, default=1)
+    parser.add_argument("--workers", help='Maximum number of windows fetched at the same time. Same as --shards by default', type=int)
+    parser.add_argument("--rate", help='Maximum number of requests per second sent to pushshift. 1 by default', type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.jobs is not None:
+        jobs = load_jobs(args.jobs)
+    elif args.keywords is not None and args.after is not None and args.before is not None:
+        jobs = [
+            {"keyword": keyword, "subreddit": subreddit, "after": f"{args.after}T00:00:00", "before": f"{args.before}T23:59:59", "target_dir": f"./cache/{subreddit}/pushshift"}
+            for subreddit in args.subreddits for keyword in args.keywords
+        ]
+    else:
+        print("Either --jobs, or --keywords with --after and --before must be specified", file=sys.stderr)
+        sys.exit(1)
+
+    http_client.configure(rate=args.rate, default_concurrency=max(args.shards, args.workers or 0, 1))
+    plans = plan_jobs(jobs)
+    print_plan(plans)
+
+    if not args.dry_run:
+        run_plan(plans, search_index.SearchIndex(args.index), args.shards, args.workers)
@@ -1,96 +1,499 @@
 import argparse
-import praw
+import collections
+import itertools
 import json
 import os
 import os.path
 import pathlib
-import logging
-import sys
-import traceback
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-def update_post_chunk(reddit, filename, updated_filename, comment_filename):
-    with open(filename, 'r') as f:
-        data = json.loads(f.read())
+from praw.models import MoreComments
 
+import chunks
+import metrics
+from author_cache import AuthorCache
+from reddit_pool import RedditPool, make_reddit_pool
+from store import open_store
+
+def load_partial(partial_filename, offset):
+    # drop whatever was written after the last checkpoint and return the submissions committed before it
+    done = dict()
+    if not os.path.exists(partial_filename):
+        return done
+
+    with open(partial_filename, "r+b") as f:
+        f.truncate(offset)
+        f.seek(0)
+        for line in f:
+            record = json.loads(line)
+            done[record["id"]] = record
+
+    return done
+
+def append_lines(f, records):
+    for record in records:
+        f.write(json.dumps(record, ensure_ascii=False).encode() + b"\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+class JsonChunk:
+    # submissions are committed to an append-only partial file, and the indented json chunk
+    # files are written in one go once every submission in the chunk is crawled
+    def __init__(self, posts_dir, comments_dir, post_no):
+        self.updated_filename = chunks.compressed(f"{posts_dir}/updated_post{post_no}.json")
+        self.comment_filename = chunks.compressed(f"{comments_dir}/post{post_no}_comment.json")
+        self.partial_filename = f"{comments_dir}/post{post_no}.partial.jsonl"
+
+    def resume(self, offset):
+        self.done = load_partial(self.partial_filename, offset or 0)
+        self.partial = open(self.partial_filename, "ab")
+        return set(self.done)
+
+    def commit(self, post, comments):
+        record = {
+            "id": post["id"],
+            "post": {key: post[key] for key in ("score", "upvote_ratio", "num_comments", "reddit_num_comments")},
+            "comments": comments,
+        }
+        append_lines(self.partial, [record])
+        self.done[post["id"]] = record
+        return self.partial.tell()
+
+    def finish(self, data):
+        self.partial.close()
+        comments_list = []
+        for post in data["data"]:
+            post.update(self.done[post["id"]]["post"])
+            comments_list.extend(self.done[post["id"]]["comments"])
+
+        chunks.write_records(self.updated_filename, data["data"], data)
+        chunks.write_records(self.comment_filename, comments_list)
+
+    def close(self):
+        self.partial.close()
+
+    def cleanup(self):
+        os.remove(self.partial_filename)
+
+class JsonlChunk:
+    # every submission is appended to the chunk files as soon as it is crawled, one record per line,
+    # so neither the crawler nor the readers ever hold more than one thread in memory.
+    # appending needs plain files, so with compression configured a chunk is compressed once it is complete.
+    def __init__(self, posts_dir, comments_dir, post_no):
+        self.updated_filename = f"{posts_dir}/updated_post{post_no}.jsonl"
+        self.comment_filename = f"{comments_dir}/post{post_no}_comment.jsonl"
+
+    def resume(self, offset):
+        # the checkpoint holds the committed length of both files
+        posts_offset, comments_offset = offset or (0, 0)
+        self.posts = open(self.updated_filename, "ab")
+        self.comments = open(self.comment_filename, "ab")
+        self.posts.truncate(posts_offset)
+        self.comments.truncate(comments_offset)
+
+        with open(self.updated_filename, "rb") as f:
+            return {json.loads(line)["id"] for line in f}
+
+    def commit(self, post, comments):
+        # comments go first, so a post line is only ever written after all of its comments
+        append_lines(self.comments, [chunks.project(comment) for comment in comments])
+        append_lines(self.posts, [chunks.project(post)])
+        return [self.posts.tell(), self.comments.tell()]
+
+    def finish(self, data):
+        self.close()
+
+    def close(self):
+        self.posts.close()
+        self.comments.close()
+
+    def cleanup(self):
+        if chunks.compression is None:
+            return
+
+        for filename in (self.updated_filename, self.comment_filename):
+            chunks.write_records(chunks.compressed(filename), chunks.iter_records(filename))
+            os.remove(filename)
+
+chunk_formats = {"json": JsonChunk, "jsonl": JsonlChunk}
+
+def crawl_submission(reddits, post, authors, cached_comments=None):
     comments_list = []
+    cached = None if cached_comments is None else cached_comments.get(f"t3_{post['id']}")
+    with reddits.borrow() as reddit:
+        if cached:
+            update_submission_from_cache(reddit, post, comments_list, authors, cached)
+        else:
+            update_submission_and_crawl_comments(reddit, post, comments_list, authors)
+    return comments_list
+
+def update_post_chunk(reddits, authors, filename, chunk, offset=None, checkpoint=None, cached_comments=None):
+    data = chunks.load_json(filename)
+
+    done = chunk.resume(offset)
+    pending = [post for post in data["data"] if post["id"] not in done]
+
+    # submissions are crawled concurrently, but committed in their original order
+    with ThreadPoolExecutor(max_workers=len(reddits)) as executor:
+        futures = [executor.submit(crawl_submission, reddits, post, authors, cached_comments) for post in pending]
+
+        try:
+            for post, future in zip(pending, futures):
+                comments = future.result()
+                offset = chunk.commit(post, comments)
+                if checkpoint is not None:
+                    checkpoint(post["id"], offset)
+                metrics.inc("comments_crawled_total", len(comments))
+                metrics.progress("crawl_comments", advance=1)
+                print(post["id"])
+        except BaseException:
+            # don't wait for submissions that were queued behind the failure
+            for future in futures:
+                future.cancel()
+            chunk.close()
+            raise
+
+    chunk.finish(data)
+    authors.save()
+
+def comment_author(comment):
+    # the listing that returned the comment already carries the author's name and fullname.
+    # reading them from the raw attributes avoids PRAW fetching every Redditor lazily.
+    attributes = vars(comment)
+    author = attributes.get("author")
+    if author is None:
+        return "[deleted]", "[deleted]"
 
-    index = 0
-    for post in data["data"]:
-        update_submission_and_crawl_comments(reddit, post, comments_list)
-        print(post["id"])
-        index += 1
+    fullname = attributes.get("author_fullname")
+    return author.name, None if fullname is None else fullname[3:]
 
-    with open(updated_filename, 'w') as f:
-        f.write(json.dumps(data, indent=4, ensure_ascii=False))
+def comment_record(comment):
+    author_name, author_id = comment_author(comment)
+    return {
+        "author_id": author_id,
+        "author_name": author_name,
+        "body": comment.body,
+        "body_html": comment.body_html,
+        "created_utc": int(comment.created_utc),
+        "distinguished": comment.distinguished,
+        "edited": int(comment.edited),
+        "id": comment.id,
+        "is_submitter": comment.is_submitter,
+        "link_id": comment.link_id,
+        "parent_id": comment.parent_id,
+        "permalink": comment.permalink,
+        "saved": comment.saved,
+        "score": comment.score,
+        "stickied": comment.stickied,
+        "subreddit_id": comment.subreddit_id,
+    }
 
-    with open(comment_filename, 'w') as f:
-        f.write(json.dumps(comments_list, indent=4, ensure_ascii=False))
+def pushshift_comment_record(comment):
+    # the same record built from a cached pushshift comment. pushshift doesn't keep body_html.
+    author_name = comment.get("author", "[deleted]")
+    fullname = comment.get("author_fullname")
+    if author_name == "[deleted]":
+        author_id = "[deleted]"
+    else:
+        author_id = None if fullname is None else fullname[3:]
 
-def update_submission_and_crawl_comments(reddit, post, comments_list):
+    return {
+        "author_id": author_id,
+        "author_name": author_name,
+        "body": comment["body"],
+        "body_html": None,
+        "created_utc": int(comment["created_utc"]),
+        "distinguished": comment.get("distinguished"),
+        "edited": int(comment.get("edited") or 0),
+        "id": comment["id"],
+        "is_submitter": comment.get("is_submitter", False),
+        "link_id": comment["link_id"],
+        "parent_id": comment["parent_id"],
+        "permalink": comment.get("permalink"),
+        "saved": False,
+        "score": comment.get("score", 0),
+        "stickied": comment.get("stickied", False),
+        "subreddit_id": comment.get("subreddit_id"),
+    }
+
+def resolve_authors(reddit, authors, records):
+    unresolved = []
+    for record in records:
+        if record["author_id"] is None:
+            unresolved.append(record["author_name"])
+        elif record["author_name"] != "[deleted]":
+            authors.put(record["author_name"], record["author_id"])
+
+    # authors missing from the listing are looked up once per submission, through the cache
+    if unresolved:
+        resolved = authors.resolve(reddit, unresolved)
+        for record in records:
+            if record["author_id"] is None:
+                author_id = resolved[record["author_name"]]
+                record["author_id"] = "[deleted]" if author_id is None else author_id
+
+def update_submission_and_crawl_comments(reddit, post, comments_list, authors):
     submission = reddit.submission(post["id"])
 
+    started = time.monotonic()
     submission.comments.replace_more(limit=None)
+    metrics.observe("comment_expansion_seconds", time.monotonic() - started, method="replace_more")
     # https://praw.readthedocs.io/en/stable/code_overview/models/comment.html
-    comments_count = 0
-    for comment in submission.comments.list():
-        comments_count += 1
-        author = comment.author
-        try:
-            if author is None or not hasattr(author, 'id'):
-                author_id = "[deleted]"
-            else:
-                author_id = author.id
-        except Exception as _:
-            logging.error(traceback.format_exc())
-            print(f"[{datetime.now().isoformat()}] submission: {post['id']}\tcomment: {comment.id}", flush=True, file=sys.stderr)
-            author_id = "[deleted]"
-
-        author_name = "[deleted]" if author is None else author.name
-        comments_list.append({
-            "author_id": author_id,
-            "author_name": author_name,
-            "body": comment.body,
-            "body_html": comment.body_html,
-            "created_utc": int(comment.created_utc),
-            "distinguished": comment.distinguished,
-            "edited": int(comment.edited),
-            "id": comment.id,
-            "is_submitter": comment.is_submitter,
-            "link_id": comment.link_id,
-            "parent_id": comment.parent_id,
-            "permalink": comment.permalink,
-            "saved": comment.saved,
-            "score": comment.score,
-            "stickied": comment.stickied,
-            "subreddit_id": comment.subreddit_id,
-        })
+    records = [comment_record(comment) for comment in submission.comments.list()]
+    resolve_authors(reddit, authors, records)
+    comments_list.extend(records)
+
+    post["score"] = submission.score
+    post["upvote_ratio"] = submission.upvote_ratio
+    post["num_comments"] = len(records)
+    # reddit's own count, which includes removed comments. refreshes compare against it.
+    post["reddit_num_comments"] = submission.num_comments
+
+def split_tree(items, records, stubs):
+    # collect loaded comments into records and unexpanded "load more comments" links into stubs
+    queue = list(items)
+    while queue:
+        item = queue.pop()
+        if isinstance(item, MoreComments):
+            stubs.append(item)
+        elif item.id not in records:
+            records[item.id] = comment_record(item)
+            queue.extend(item.replies)
+
+def update_submission_from_cache(reddit, post, comments_list, authors, cached, batch_size=100):
+    # start from the comments pushshift already has, and only ask reddit for what it is missing.
+    # the ids behind every "load more comments" link are known up front, so instead of expanding
+    # them one by one with replace_more, missing comments are fetched by id, 100 per request.
+    submission = reddit.submission(post["id"])
+    started = time.monotonic()
+    records = dict()
+    stubs = []
+    split_tree(submission.comments, records, stubs)
+
+    missing = []
+    while stubs:
+        more = stubs.pop()
+        if more.children:
+            missing.extend(comment_id for comment_id in more.children if comment_id not in records and comment_id not in cached)
+        else:
+            # "continue this thread" links don't list their comments, so they are expanded as usual
+            split_tree(more.comments(), records, stubs)
+
+    # cached comments go through the same requests, which refreshes their scores
+    wanted = missing + [comment_id for comment_id in cached if comment_id not in records]
+    for start in range(0, len(wanted), batch_size):
+        fullnames = [f"t1_{comment_id}" for comment_id in wanted[start:start + batch_size]]
+        for comment in reddit.info(fullnames=fullnames):
+            records[comment.id] = comment_record(comment)
+
+    metrics.observe("comment_expansion_seconds", time.monotonic() - started, method="by_id")
+
+    # comments reddit no longer returns are kept as pushshift saw them
+    for comment_id, comment in cached.items():
+        if comment_id not in records:
+            records[comment_id] = pushshift_comment_record(comment)
+
+    records = sorted(records.values(), key=lambda record: record["created_utc"])
+    resolve_authors(reddit, authors, records)
+    comments_list.extend(records)
 
     post["score"] = submission.score
     post["upvote_ratio"] = submission.upvote_ratio
-    post["num_comments"] = comments_count
+    post["num_comments"] = len(records)
+    post["reddit_num_comments"] = submission.num_comments
+
+class PushshiftComments:
+    # the comments cached by pushshift.py, read one thread at a time. only the chunks holding each thread
+    # are kept in memory, so a keyword cache larger than memory can be used.
+    def __init__(self, comments_dir):
+        self.filenames = collections.defaultdict(list)
+        for _, filename in chunks.iter_chunks(comments_dir, "comment{}"):
+            for link_id in {comment["link_id"] for comment in chunks.iter_records(filename)}:
+                self.filenames[link_id].append(filename)
+
+    def get(self, link_id):
+        # {comment_id: comment} for the cached comments of `link_id`, or None if pushshift has none
+        if link_id not in self.filenames:
+            return None
+
+        return {
+            comment["id"]: comment
+            for filename in self.filenames[link_id]
+            for comment in chunks.iter_records(filename)
+            if comment["link_id"] == link_id
+        }
 
-def crawl_comments(reddit, posts_dir):
-    post_no = 1
+def praw_dirs(posts_dir):
+    # ./cache/pushshift/posts/<keyword> -> (./cache/praw/comments/<keyword>, ./cache/praw)
     posts_path = pathlib.PurePath(posts_dir)
     keyword = posts_path.stem
-    comments_dir = str(posts_path.parents[2].joinpath(f"praw/comments/{keyword}"))
+    praw_dir = posts_path.parents[2].joinpath("praw")
+    return str(praw_dir.joinpath(f"comments/{keyword}")), str(praw_dir)
+
+def refresh_chunk(reddits, authors, updated_filename, comment_filename, batch_size=100, cached_comments=None):
+    if chunks.is_jsonl(updated_filename):
+        wrapper = None
+        posts = list(chunks.iter_records(updated_filename))
+    else:
+        wrapper = chunks.load_json(updated_filename)
+        posts = wrapper["data"]
+
+    # one request refreshes up to 100 submissions
+    submissions = dict()
+    for start in range(0, len(posts), batch_size):
+        fullnames = [f"t3_{post['id']}" for post in posts[start:start + batch_size]]
+        with reddits.borrow() as reddit:
+            for submission in reddit.info(fullnames=fullnames):
+                submissions[submission.id] = submission
+
+    changed = []
+    for post in posts:
+        submission = submissions.get(post["id"])
+        if submission is None:
+            continue
+
+        post["score"] = submission.score
+        post["upvote_ratio"] = submission.upvote_ratio
+        if submission.num_comments != post.get("reddit_num_comments", post["num_comments"]):
+            changed.append(post)
+
+    # only threads whose comment count moved are crawled again
+    with ThreadPoolExecutor(max_workers=len(reddits)) as executor:
+        recrawled = dict(zip(
+            (post["id"] for post in changed),
+            executor.map(lambda post: crawl_submission(reddits, post, authors, cached_comments), changed),
+        ))
+
+    def merged_comments():
+        for link_id, thread in itertools.groupby(chunks.iter_records(comment_filename), key=lambda comment: comment["link_id"]):
+            post_id = link_id[3:]
+            if post_id in recrawled:
+                yield from recrawled.pop(post_id)
+            else:
+                yield from thread
+
+        # threads that had no comments before
+        for comments in recrawled.values():
+            yield from comments
+
+    chunks.write_records(comment_filename, merged_comments())
+    chunks.write_records(updated_filename, posts, wrapper)
+    authors.save()
+
+    return len(changed)
+
+def refresh_comments(reddits, posts_dir, pushshift_comments_dir=None):
+    if not isinstance(reddits, RedditPool):
+        reddits = RedditPool([reddits])
+
+    comments_dir, praw_dir = praw_dirs(posts_dir)
+    authors = AuthorCache(f"{praw_dir}/authors.json")
+    cached_comments = None if pushshift_comments_dir is None else PushshiftComments(pushshift_comments_dir)
+
+    for post_no, updated_filename in chunks.iter_chunks(posts_dir, "updated_post{}"):
+        comment_filename = chunks.chunk_filename(comments_dir, f"post{post_no}_comment")
+        if comment_filename is None:
+            break
+
+        changed = refresh_chunk(reddits, authors, updated_filename, comment_filename, cached_comments=cached_comments)
+        print(f"{post_no}: {changed} threads crawled again")
+
+def crawl_comments(reddits, posts_dir, output_format="json", pushshift_comments_dir=None):
+    if not isinstance(reddits, RedditPool):
+        reddits = RedditPool([reddits])
+
+    comments_dir, praw_dir = praw_dirs(posts_dir)
 
     if not os.path.exists(comments_dir):
         os.makedirs(comments_dir)
 
-    while os.path.exists(f"{posts_dir}/post{post_no}.json"):
-        filename = f"{posts_dir}/post{post_no}.json"
-        updated_filename = f"{posts_dir}/updated_post{post_no}.json"
-        comments_filename = f"{comments_dir}/post{post_no}_comment.json"
-        update_post_chunk(reddit, filename, updated_filename, comments_filename)
+    # the author cache is shared by every keyword
+    authors = AuthorCache(f"{praw_dir}/authors.json")
+    cached_comments = None if pushshift_comments_dir is None else PushshiftComments(pushshift_comments_dir)
+
+    # the manifest records the last fully written chunk, and within the chunk in progress
+    # the last crawled submission and how far its output is committed
+    manifest_filename = f"{comments_dir}/manifest.json"
+    manifest = chunks.load_json(manifest_filename, {"completed": 0, "last_id": None, "offset": None})
+    if manifest["completed"] > 0 or manifest["last_id"] is not None:
+        print(f"Resuming after chunk {manifest['completed']}, submission {manifest['last_id']}")
+
+    def checkpoint(last_id, offset):
+        manifest.update(last_id=last_id, offset=offset)
+        chunks.save_json(manifest_filename, manifest)
+
+    post_no = manifest["completed"] + 1
+    remaining = [filename for number, filename in chunks.iter_chunks(posts_dir, "post{}") if number >= post_no]
+    metrics.progress("crawl_comments", done=0, total=sum(len(chunks.load_json(filename)["data"]) for filename in remaining))
+
+    filename = chunks.chunk_filename(posts_dir, f"post{post_no}")
+    while filename is not None:
+        chunk = chunk_formats[output_format](posts_dir, comments_dir, post_no)
+        update_post_chunk(reddits, authors, filename, chunk, manifest["offset"], checkpoint, cached_comments)
+
+        manifest.update(completed=post_no, last_id=None, offset=None)
+        chunks.save_json(manifest_filename, manifest)
+        chunk.cleanup()
         post_no += 1
+        filename = chunks.chunk_filename(posts_dir, f"post{post_no}")
+
+def crawl_store(reddits, store, keyword, cached_comments=None):
+    # crawl the comments of every post listed under `keyword` that no keyword has crawled yet.
+    # each thread is committed to the store as soon as it is crawled, so reruns pick up where they stopped.
+    if not isinstance(reddits, RedditPool):
+        reddits = RedditPool([reddits])
+
+    authors = AuthorCache(f"{store.root}/authors.json")
+    pending = [post_id for post_id in store.keyword_ids(keyword) if not store.has_comments(post_id)]
+    print(f"{len(pending)} posts without comments")
+
+    def crawl(post_id):
+        post = store.get_post(post_id)
+        comments = crawl_submission(reddits, post, authors, cached_comments)
+        store.put_comments(post, comments)
+        metrics.inc("comments_crawled_total", len(comments))
+        return post_id
+
+    metrics.progress("crawl_comments", done=0, total=len(pending))
+    with ThreadPoolExecutor(max_workers=len(reddits)) as executor:
+        for post_id in executor.map(crawl, pending):
+            metrics.progress("crawl_comments", advance=1)
+            print(post_id)
+
+    authors.save()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--posts-dir", help='Where posts are cached at (by pushshift). ex> ./cache/pushshift/posts/dao', required=True)
+    parser.add_argument("--posts-dir", help='Where posts are cached at (by pushshift). ex> ./cache/pushshift/posts/dao')
+    parser.add_argument("--store", help='Crawl the posts of --keyword in the post store shared by every keyword instead of --posts-dir. A .db file is a sqlite store. ex> ./cache/store or ./cache/store.db')
+    parser.add_argument("--keyword", help='Which keyword of --store to crawl. ex> dao')
+    parser.add_argument("--workers", help='Number of submissions crawled at the same time. 1 by default', type=int, default=1)
+    parser.add_argument("--sites", help='praw.ini sites to spread the workers over. Each site has its own quota. "bot" by default', nargs="+", default=["bot"])
+    parser.add_argument("--rate", help='Maximum number of requests per second across all sites. Unlimited by default', type=float)
+    parser.add_argument("--format", help='Supported values: "json" | "jsonl" (without double quotes). jsonl appends every submission as it is crawled. json by default', choices=chunk_formats.keys(), default="json")
+    parser.add_argument("--pushshift-comments-dir", help='Start from the comments cached by pushshift.py and only fetch the missing ones from reddit. ex> ./cache/pushshift/comments/dao')
+    parser.add_argument("--refresh", help='Refresh scores of already crawled posts, and crawl comments again only for posts whose comment count changed', action="store_true")
+    parser.add_argument("--compress", help='Compress the written chunks. zstd needs the zstandard package. Uncompressed by default', choices=chunks.compression_suffixes.keys())
+    parser.add_argument("--drop-fields", help='Fields left out of the written posts and comments. ex> body_html', nargs="+", default=[])
+    parser.add_argument("--metrics-file", help='Write request latencies, throttling, comment expansion times and progress to this file every --metrics-interval seconds. A .prom file gets the Prometheus text format, anything else json. ex> ./metrics/praw.prom')
+    parser.add_argument("--metrics-interval", help='Seconds between metrics exports. 10 by default', type=float, default=10.0)
     args = parser.parse_args()
+    chunks.configure(args.compress, args.drop_fields)
+
+    if (args.posts_dir is None) == (args.store is None) or (args.store is not None and args.keyword is None):
+        parser.error("either --posts-dir, or --store with --keyword is required")
 
-    # About User Agent Naming Convention: https://github.com/reddit-archive/reddit/wiki/API
-    reddit = praw.Reddit("bot", user_agent="python3:ethereum-dao-search:v1.0 (by /u/pacokwon)")
-    crawl_comments(reddit, args.posts_dir)
+    reddits = make_reddit_pool(args.sites, args.workers, args.rate)
+    exporter = metrics.start_export(args.metrics_file, args.metrics_interval)
+    try:
+        if args.store is not None:
+            cached_comments = None if args.pushshift_comments_dir is None else PushshiftComments(args.pushshift_comments_dir)
+            crawl_store(reddits, open_store(args.store), args.keyword, cached_comments)
+        elif args.refresh:
+            refresh_comments(reddits, args.posts_dir, args.pushshift_comments_dir)
+        else:
+            crawl_comments(reddits, args.posts_dir, args.format, args.pushshift_comments_dir)
+    finally:
+        if exporter is not None:
+            exporter.stop()
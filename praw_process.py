@@ -1,14 +1,21 @@
 import argparse
-import requests
 import csv
 import os
 import os.path
-import json
 import sys
+import tempfile
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 
-posts_dir = "./cache/posts"
-comments_dir = "./reddit/comments"
+import chunks
+import columnar
+import http_client
+import metrics
+from store import open_store
+from thread_index import ThreadIndex
+
+submission_url = "https://api.pushshift.io/reddit/search/submission"
 
 def resolve_post_content(post):
     # determine a post's main content. it might be just text, or a link
@@ -24,152 +31,319 @@ def resolve_post_content(post):
 
     return post["url"]
 
-def process_posts(posts_dir, target_dir):
-    fieldnames = ["num_post", "title", "author", "date", "contents", "comments", "votes", "link", "upvote_ratio"]
+post_fieldnames = ["num_post", "title", "author", "date", "contents", "comments", "votes", "link", "upvote_ratio"]
+comment_fieldnames = ["num_comment", "author_id", "author_name", "comment_id", "date", "contents", "votes", "post_link", "comment_link", "reply_to", "nested_level", "root_id", "num_replies", "subtree_size", "subtree_score"]
+
+def post_row(post, index):
+    contents = resolve_post_content(post)
+    if "upvote_ratio" not in post:
+        print(post)
+
+    return {
+        "num_post": index,
+        "title": post["title"],
+        "author": post["author"],
+        "date": datetime.fromtimestamp(post["created_utc"]),
+        "contents": contents,
+        "comments": post["num_comments"],
+        "votes": post["score"],
+        "link": post["full_link"],
+        "upvote_ratio": post["upvote_ratio"]
+    }
+
+def iter_threads(records):
+    # comments of a submission are stored next to each other. nesting never crosses submissions,
+    # so only one thread has to be held in memory at a time.
+    for _, thread in itertools.groupby(records, key=lambda comment: comment["link_id"]):
+        yield list(thread)
+
+def thread_rows(thread, index):
+    # rows for the comments of a single submission, numbered from `index`
+    tindex = ThreadIndex(thread)
+    for comment in thread:
+        post_id = comment["link_id"][3:]
+        # there are some comments that do not contain "nest_level". In that case compare the link id with the parent id.
+        is_reply = comment["link_id"] != comment["parent_id"]
+        reply_id = comment["parent_id"][3:]
+        comment_id = comment['id']
+
+        yield {
+            "num_comment": index,
+            "author_id": comment["author_id"],
+            "author_name": comment["author_name"],
+            "comment_id": comment_id,
+            "date": datetime.fromtimestamp(comment["created_utc"]),
+            "contents": comment["body"],
+            "votes": comment["score"],
+            "post_link": f"https://www.reddit.com/comments/{post_id}",
+            "comment_link": f"https://www.reddit.com/comments/{post_id}/comment/{comment_id}",
+            "reply_to": f"https://www.reddit.com/comments/{post_id}/comment/{reply_id}" if is_reply else "",
+            "nested_level": tindex.depth[comment_id] + 1,
+            "root_id": tindex.root[comment_id],
+            "num_replies": tindex.replies[comment_id],
+            "subtree_size": tindex.size[comment_id],
+            "subtree_score": tindex.score[comment_id],
+        }
+        index += 1
+
+def convert_chunk(kind, filename, segment_filename):
+    # write the rows of one chunk to a segment, without their numbers. the numbers are only
+    # known once every chunk before this one is converted, so they are added when merging.
+    fieldnames = post_fieldnames if kind == "posts" else comment_fieldnames
+    with open(segment_filename, "w", newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames[1:], quoting=csv.QUOTE_MINIMAL, extrasaction="ignore")
+        if kind == "posts":
+            for post in chunks.iter_records(filename):
+                writer.writerow(post_row(post, 0))
+        else:
+            for thread in iter_threads(chunks.iter_records(filename)):
+                writer.writerows(thread_rows(thread, 0))
+
+    return segment_filename
+
+def chunk_signature(filename):
+    stat = os.stat(filename)
+    return {"filename": filename, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+def export_chunks(kind, filenames, output_filename, jobs=1, incremental=False):
+    # convert chunks to segments, on a process pool when jobs > 1, and append the segments in chunk order.
+    # incremental exports keep the segments and a manifest with every chunk's signature, row range and
+    # where its rows end in the output. the output is then kept up to the first chunk that changed, and
+    # only chunks whose signature changed are converted again.
+    output_dir = os.path.dirname(output_filename) or "."
+    if incremental:
+        segments_dir = f"{output_dir}/.segments"
+        if not os.path.exists(segments_dir):
+            os.makedirs(segments_dir)
+        merge_chunks(kind, filenames, output_filename, segments_dir, jobs, incremental)
+        return
+
+    # other runs get a scratch directory of their own, so the segments and manifests
+    # of incremental exports to the same directory are left alone
+    with tempfile.TemporaryDirectory(prefix=".segments-", dir=output_dir) as segments_dir:
+        merge_chunks(kind, filenames, output_filename, segments_dir, jobs, incremental)
+
+def merge_chunks(kind, filenames, output_filename, segments_dir, jobs, incremental):
+    fieldnames = post_fieldnames if kind == "posts" else comment_fieldnames
+    segment_filenames = [f"{segments_dir}/{kind}{n}.csv" for n in range(1, len(filenames) + 1)]
+    manifest_filename = f"{segments_dir}/{kind}.json"
+
+    signatures = [chunk_signature(filename) for filename in filenames]
+    manifest = chunks.load_json(manifest_filename, {"fieldnames": fieldnames, "chunks": []}) if incremental else None
+    entries = manifest["chunks"] if incremental else []
+    # segments written for other columns, or for an output that is gone, can't be reused
+    if not os.path.exists(output_filename) or (incremental and manifest.get("fieldnames") != fieldnames):
+        entries = []
+
+    def unchanged(n):
+        return (n < len(entries)
+                and {key: entries[n][key] for key in signatures[n]} == signatures[n]
+                and os.path.exists(segment_filenames[n]))
+
+    keep = 0
+    while keep < len(signatures) and unchanged(keep):
+        keep += 1
+    if keep > 0 and os.path.getsize(output_filename) < entries[keep - 1]["end"]:
+        keep = 0
+
+    stale = [n for n in range(keep, len(filenames)) if not unchanged(n)]
+    stale_set = set(stale)
+    if incremental and os.path.exists(output_filename) and keep == len(filenames) == len(entries):
+        print(f"{output_filename} is up to date")
+        return
+
+    # only claim what is kept, in case we are interrupted while rewriting the rest
+    entries = entries[:keep]
+    if incremental:
+        chunks.save_json(manifest_filename, {"fieldnames": fieldnames, "chunks": entries})
+
+    if keep > 0:
+        with open(output_filename, "r+b") as f:
+            f.truncate(entries[-1]["end"])
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor, open(output_filename, "a" if keep > 0 else "w", newline='') as csvfile:
+        converted = executor.map(convert_chunk, itertools.repeat(kind), [filenames[n] for n in stale], [segment_filenames[n] for n in stale])
+        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+        if keep == 0:
+            writer.writerow(fieldnames)
+
+        index = entries[-1]["start"] + entries[-1]["rows"] if entries else 1
+        for n in range(keep, len(filenames)):
+            # segments are converted in the order they are appended
+            if n in stale_set:
+                next(converted)
+
+            start = index
+            with open(segment_filenames[n], newline='') as f:
+                for row in csv.reader(f):
+                    writer.writerow([index, *row])
+                    index += 1
+            csvfile.flush()
+            entries.append({**signatures[n], "rows": index - start, "start": start, "end": csvfile.buffer.tell()})
+            metrics.inc("rows_written_total", index - start, kind=kind)
+            metrics.progress(f"process_{kind}", done=n + 1, total=len(filenames))
+
+            if not incremental:
+                os.remove(segment_filenames[n])
+
+    if incremental:
+        chunks.save_json(manifest_filename, {"fieldnames": fieldnames, "chunks": entries})
+
+    print(f"{len(stale)} of {len(filenames)} chunks converted, {len(filenames) - keep} appended")
+
+def process_posts(posts_dir, target_dir, jobs=1, incremental=False):
+    if jobs > 1 or incremental:
+        filenames = [filename for _, filename in chunks.iter_chunks(posts_dir, "updated_post{}")]
+        export_chunks("posts", filenames, f"{target_dir}/posts.csv", jobs, incremental)
+        print(f"Finished. Results stored in {target_dir}/posts.csv")
+        return
+
     with open(f"{target_dir}/posts.csv", "w", newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
+        writer = csv.DictWriter(csvfile, fieldnames=post_fieldnames, quoting=csv.QUOTE_MINIMAL)
         writer.writeheader()
 
-        post_no = 1
+        filenames = [filename for _, filename in chunks.iter_chunks(posts_dir, "updated_post{}")]
         index = 1
-        while os.path.exists(f"{posts_dir}/updated_post{post_no}.json"):
-            with open(f"{posts_dir}/updated_post{post_no}.json") as f:
-                data = json.loads(f.read())
-
-            for post in data["data"]:
-                contents = resolve_post_content(post)
-                if "upvote_ratio" not in post:
-                    print(post)
-
-                writer.writerow({
-                    "num_post": index,
-                    "title": post["title"],
-                    "author": post["author"],
-                    "date": datetime.fromtimestamp(post["created_utc"]),
-                    "contents": contents,
-                    "comments": post["num_comments"],
-                    "votes": post["score"],
-                    "link": post["full_link"],
-                    "upvote_ratio": post["upvote_ratio"]
-                })
+        for n, filename in enumerate(filenames, 1):
+            start = index
+            for post in chunks.iter_records(filename):
+                writer.writerow(post_row(post, index))
                 index += 1
-
-            post_no += 1
+            metrics.inc("rows_written_total", index - start, kind="posts")
+            metrics.progress("process_posts", done=n, total=len(filenames))
 
     print(f"Finished. Results stored in {target_dir}/posts.csv")
 
-def process_comments(comments_dir, target_dir):
-    fieldnames = ["num_comment", "author_id", "author_name", "comment_id", "date", "contents", "votes", "post_link", "comment_link", "reply_to", "nested_level"]
+def process_comments(comments_dir, target_dir, jobs=1, incremental=False):
+    if jobs > 1 or incremental:
+        filenames = [filename for _, filename in chunks.iter_chunks(comments_dir, "post{}_comment")]
+        export_chunks("comments", filenames, f"{target_dir}/comments.csv", jobs, incremental)
+        print(f"Finished. Results stored in {target_dir}/comments.csv")
+        return
+
     with open(f"{target_dir}/comments.csv", "w", newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
+        writer = csv.DictWriter(csvfile, fieldnames=comment_fieldnames, quoting=csv.QUOTE_MINIMAL)
         writer.writeheader()
 
-        post_no = 1
+        filenames = [filename for _, filename in chunks.iter_chunks(comments_dir, "post{}_comment")]
         index = 1
-        while os.path.exists(f"{comments_dir}/post{post_no}_comment.json"):
-            with open(f"{comments_dir}/post{post_no}_comment.json") as f:
-                data = json.loads(f.read())
-
-            nmap = make_nested_map(data)
-            for comment in data:
-                post_id = comment["link_id"][3:]
-                # there are some comments that do not contain "nest_level". In that case compare the link id with the parent id.
-                is_reply = comment["link_id"] != comment["parent_id"]
-                reply_id = comment["parent_id"][3:]
-                comment_id = comment['id']
-
-                writer.writerow({
-                    "num_comment": index,
-                    "author_id": comment["author_id"],
-                    "author_name": comment["author_name"],
-                    "comment_id": comment_id,
-                    "date": datetime.fromtimestamp(comment["created_utc"]),
-                    "contents": comment["body"],
-                    "votes": comment["score"],
-                    "post_link": f"https://www.reddit.com/comments/{post_id}",
-                    "comment_link": f"https://www.reddit.com/comments/{post_id}/comment/{comment_id}",
-                    "reply_to": f"https://www.reddit.com/comments/{post_id}/comment/{reply_id}" if is_reply else "",
-                    "nested_level": nmap[comment_id] + 1,
-                })
-                index += 1
-
-            post_no += 1
+        for n, filename in enumerate(filenames, 1):
+            start = index
+            for thread in iter_threads(chunks.iter_records(filename)):
+                writer.writerows(thread_rows(thread, index))
+                index += len(thread)
+            metrics.inc("rows_written_total", index - start, kind="comments")
+            metrics.progress("process_comments", done=n, total=len(filenames))
 
     print(f"Finished. Results stored in {target_dir}/comments.csv")
 
-def make_nested_map(data):
-    parent_map = dict()
-    nested_map = dict()
-
-    def record_nest(comment_id):
-        if comment_id in nested_map:
-            return
+def export_columnar(kind, filenames, target_dir, output_format):
+    # convert every chunk into a batch of typed columns and write <target_dir>/<kind>.<format>,
+    # along with <kind>_authors.<format> resolving the author codes
+    authors = columnar.AuthorCodes()
+    output_filename = f"{target_dir}/{kind}.{output_format}"
+    writer = columnar.ColumnarWriter(output_filename, output_format)
+    index = 1
+    for filename in filenames:
+        records = list(chunks.iter_records(filename))
+        if kind == "posts":
+            writer.write(columnar.post_batch(records, [resolve_post_content(post) for post in records], index, authors))
+        else:
+            writer.write(columnar.comment_batch(records, index, authors))
+        index += len(records)
+    writer.close()
 
-        parent = parent_map[comment_id]
-        if parent == "":
-            nested_map[comment_id] = 0
-            return
+    columnar.write_table(authors.columns(), f"{target_dir}/{kind}_authors.{output_format}", output_format)
+    print(f"Finished. Results stored in {output_filename}")
 
-        if parent not in nested_map:
-            record_nest(parent)
+def process_store(store, keyword, target_dir):
+    # export a keyword of the shared post store. posts come in the order pushshift returned them.
+    with open(f"{target_dir}/posts.csv", "w", newline='') as posts_file, open(f"{target_dir}/comments.csv", "w", newline='') as comments_file:
+        post_writer = csv.DictWriter(posts_file, fieldnames=post_fieldnames, quoting=csv.QUOTE_MINIMAL)
+        comment_writer = csv.DictWriter(comments_file, fieldnames=comment_fieldnames, quoting=csv.QUOTE_MINIMAL)
+        post_writer.writeheader()
+        comment_writer.writeheader()
 
-        nested_map[comment_id] = 1 + nested_map[parent]
+        comment_index = 1
+        for index, (post, thread) in enumerate(store.iter_keyword(keyword), 1):
+            post_writer.writerow(post_row(post, index))
+            comment_writer.writerows(thread_rows(thread, comment_index))
+            comment_index += len(thread)
 
-    for record in data:
-        parent_id = record["parent_id"]
-        if parent_id[1] == "3":
-            parent_map[record["id"]] = ""
-        else:
-            parent_map[record["id"]] = parent_id[3:]
+    print(f"Finished. Results stored in {target_dir}/posts.csv and {target_dir}/comments.csv")
 
-    for record in data:
-        record_nest(record["id"])
+def make_nested_map(data):
+    return ThreadIndex(data).depth
+
+def is_deleted(text):
+    return text in ("[deleted]", "[removed]")
+
+def recover_deleted_posts(posts_dir, batch_size=100, workers=4):
+    # posts whose contents reddit reports as "[deleted]" may still have their original text on pushshift.
+    # every checked id is remembered in recovered.json, with its text or None, so reruns only ask about
+    # posts they haven't seen. recovered text is written back into the chunks.
+    # pushshift returns at most 100 results per request, so larger batches would lose ids.
+    batch_size = min(batch_size, 100)
+    client = http_client.get_client()
+    record_filename = f"{posts_dir}/recovered.json"
+    recovered = chunks.load_json(record_filename, dict())
+
+    ids = []
+    for _, filename in chunks.iter_chunks(posts_dir, "updated_post{}"):
+        for post in chunks.iter_records(filename):
+            if post.get("selftext") == "[deleted]" and post["id"] not in recovered:
+                ids.append(post["id"])
 
-    return nested_map
+    def check(batch):
+        data = client.get_json(submission_url, params={"ids": ",".join(batch), "size": len(batch)})["data"]
+        # batches fit in one response, so an id missing from it is one pushshift doesn't have
+        found = {record["id"]: record.get("selftext", "[deleted]") for record in data}
+        texts = {post_id: found.get(post_id, "[deleted]") for post_id in batch}
+        return {post_id: None if is_deleted(text) else text for post_id, text in texts.items()}
+
+    batches = [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for checked, results in enumerate(executor.map(check, batches), 1):
+            recovered.update(results)
+            chunks.save_json(record_filename, recovered)
+            print(f"{checked:5} / {len(batches)} batches checked.", end="\r")
+    if batches:
+        print()
 
-# Check if posts that have their contents collected as "[deleted]" from reddit
-# is also collected as "[deleted]" from pushshift.
-def check_posts():
     count = 0
-    post_no = 1
-    while os.path.exists(f"{posts_dir}/updated_post{post_no}.json"):
-        with open(f"{posts_dir}/updated_post{post_no}.json") as f:
-            data = json.loads(f.read())
-
-        ids = []
-        for post in data["data"]:
-            if "selftext" not in post:
-                continue
-
-            if post["selftext"] == "[deleted]":
-                ids.append(post["id"])
+    for _, filename in chunks.iter_chunks(posts_dir, "updated_post{}"):
+        if chunks.is_jsonl(filename):
+            wrapper = None
+            posts = list(chunks.iter_records(filename))
+        else:
+            wrapper = chunks.load_json(filename)
+            posts = wrapper["data"]
+
+        changed = False
+        for post in posts:
+            if post.get("selftext") == "[deleted]" and recovered.get(post["id"]) is not None:
+                post["selftext"] = recovered[post["id"]]
+                changed = True
                 count += 1
 
-                if len(ids) > 20:
-                    results = requests.get("http://api.pushshift.io/reddit/search/submission?ids=" + ",".join(ids))
-                    data = results.json()["data"]
-                    for record in data:
-                        if record["selftext"] != "[deleted]":
-                            print(record["id"], record["selftext"])
-
-                    ids = []
+        if changed:
+            chunks.write_records(filename, posts, wrapper)
 
-        if ids:
-            results = requests.get("http://api.pushshift.io/reddit/search/submission?ids=" + ",".join(ids))
-            data = results.json()["data"]
-            for record in data:
-                if record["selftext"] != "[deleted]":
-                    print(record["id"], record["selftext"])
-
-        post_no += 1
-
-    print(count)
+    print(f"Checked {len(ids)} deleted posts. Recovered {count} posts.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--output-dir", help='Directory to write results to. ./results by default', default="./results")
     parser.add_argument("--posts-dir", help='Where posts are cached at. ex> ./cache/pushshift/posts/dao')
     parser.add_argument("--comments-dir", help='Where comments are cached at. ex> ./cache/praw/comments/dao')
+    parser.add_argument("--store", help='Export --keyword from the post store shared by every keyword. A .db file is a sqlite store. ex> ./cache/store or ./cache/store.db')
+    parser.add_argument("--keyword", help='Which keyword of --store to export. ex> dao')
+    parser.add_argument("--jobs", help='Number of processes converting chunks at the same time. 1 by default', type=int, default=1)
+    parser.add_argument("--incremental", help='Only convert chunks that changed since the last --incremental run', action="store_true")
+    parser.add_argument("--format", help='Output formats. parquet and arrow need pyarrow, npz needs numpy. csv by default. ex> csv parquet', nargs="+", choices=("csv",) + columnar.columnar_formats, default=["csv"])
+    parser.add_argument("--metrics-file", help='Write conversion progress and timings to this file every --metrics-interval seconds. A .prom file gets the Prometheus text format, anything else json. ex> ./metrics/process.prom')
+    parser.add_argument("--metrics-interval", help='Seconds between metrics exports. 10 by default', type=float, default=10.0)
+    parser.add_argument("--recover-deleted", help='Before processing posts, look up posts deleted on reddit on pushshift and write back their original contents', action="store_true")
     args = parser.parse_args()
 
     output_dir = args.output_dir
@@ -177,12 +351,35 @@ if __name__ == "__main__":
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    if args.store is not None:
+        if args.keyword is None:
+            print("The --keyword option must be specified for --store", file=sys.stderr)
+            sys.exit(1)
+        process_store(open_store(args.store), args.keyword, output_dir)
+        sys.exit(0)
+
     if args.posts_dir is None and args.comments_dir is None:
         print("No arguments are specified. Exiting...")
         sys.exit(1)
 
-    if args.posts_dir is not None:
-        process_posts(args.posts_dir, output_dir)
+    exporter = metrics.start_export(args.metrics_file, args.metrics_interval)
+    try:
+        if args.posts_dir is not None and args.recover_deleted:
+            recover_deleted_posts(args.posts_dir)
 
-    if args.comments_dir is not None:
-        process_comments(args.comments_dir, output_dir)
+        if args.posts_dir is not None and "csv" in args.format:
+            process_posts(args.posts_dir, output_dir, args.jobs, args.incremental)
+
+        if args.comments_dir is not None and "csv" in args.format:
+            process_comments(args.comments_dir, output_dir, args.jobs, args.incremental)
+
+        for output_format in columnar.columnar_formats:
+            if output_format not in args.format:
+                continue
+            if args.posts_dir is not None:
+                export_columnar("posts", [filename for _, filename in chunks.iter_chunks(args.posts_dir, "updated_post{}")], output_dir, output_format)
+            if args.comments_dir is not None:
+                export_columnar("comments", [filename for _, filename in chunks.iter_chunks(args.comments_dir, "post{}_comment")], output_dir, output_format)
+    finally:
+        if exporter is not None:
+            exporter.stop()
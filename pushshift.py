@@ -1,12 +1,21 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import csv
+import heapq
 import json
 import math
 import os
 import os.path
-import requests
+import shutil
 import sys
+import threading
+
+import chunks
+import http_client
+import metrics
+import search_index
+from store import import_posts, open_store
 
 # Ethereum reddit forum에서 2016-2018년 사이에 dao 키워드를 포함한 게시물과 그 댓글
 
@@ -15,22 +24,170 @@ import sys
 posts_dir = "posts"
 comments_dir = "comments"
 
-def cache_posts(keyword, after, before, subreddit, target_dir="./cache/pushshift"):
+submission_url = "https://api.pushshift.io/reddit/search/submission"
+comment_url = "https://api.pushshift.io/reddit/search/comment"
+page_size = 250
+
+def to_windows(cuts):
+    # pushshift's "after" and "before" are both exclusive, so every window but the first
+    # starts one second early to keep results created exactly on a cut.
+    return [(cuts[i] if i == 0 else cuts[i] - 1, cuts[i + 1]) for i in range(len(cuts) - 1)]
+
+def fetch_total(url, params, after, before):
+    response_json = http_client.get_client().get_json(url, params={**params, "after": after, "before": before, "size": 0})
+    return response_json["metadata"]["total_results"]
+
+def plan_windows(url, params, start_time, end_time, shards, workers=None):
+    # sample the result density over more, narrower windows than we need, then cut the range
+    # so that every shard holds roughly the same number of results.
+    step = max(1, (end_time - start_time) // (shards * 4))
+    probes = to_windows(list(range(start_time, end_time, step)) + [end_time])
+    with ThreadPoolExecutor(max_workers=workers or shards) as executor:
+        counts = list(executor.map(lambda window: fetch_total(url, params, *window), probes))
+
+    target = sum(counts) / shards
+    cuts = [start_time]
+    accumulated = 0
+    for (_, before), count in zip(probes[:-1], counts[:-1]):
+        accumulated += count
+        if len(cuts) < shards and accumulated >= target * len(cuts):
+            cuts.append(before)
+    cuts.append(end_time)
+
+    return to_windows(cuts)
+
+def iter_pages(url, params, after, before, seen=()):
+    # paginate in ascending order. "after" is exclusive, so every page asks again for the second the
+    # previous page ended in, and drops the results of that second it has already seen. this neither
+    # skips nor duplicates results created in the same second across a page boundary.
+    # yields (page, cursor), where the cursor resumes right after the page.
+    seen = set(seen)
+    while True:
+        response_json = http_client.get_client().get_json(url, params={**params, "after": after, "before": before})
+        data = response_json["data"]
+        if not data:
+            return
+
+        fresh = [record for record in data if record["id"] not in seen]
+        if not fresh:
+            # nothing new in the boundary second, or more results in a single second than fit on a page
+            after += 1
+            seen = set()
+            continue
+
+        last_time = fresh[-1]["created_utc"]
+        boundary = {record["id"] for record in fresh if record["created_utc"] == last_time}
+        seen = boundary | seen if last_time - 1 == after else boundary
+        after = last_time - 1
+        yield {**response_json, "data": fresh}, {"after": after, "seen": sorted(seen)}
+
+def fetch_window(url, params, window, page_dir, prefix, commit, on_page=None):
+    # paginate a single window, starting from its last committed cursor
+    if window["done"]:
+        return
+
+    for page, cursor in iter_pages(url, params, window["after"], window["before"], window.get("seen", [])):
+        page = {**page, "data": [chunks.project(record) for record in page["data"]]}
+        chunks.write_chunk(chunks.compressed(f"{page_dir}/{prefix}{window['pages'] + 1}.json"), json.dumps(page, ensure_ascii=False))
+        if on_page is not None:
+            on_page(page["data"])
+        commit(window, pages=window["pages"] + 1, **cursor)
+
+    commit(window, done=True)
+
+def cache_pages(url, params, start_time, end_time, cache_dir, prefix, shards=1, workers=None, windows=None, on_page=None):
+    # `windows` fixes the time windows to crawl instead of splitting the range into `shards`.
+    # `on_page` is called with the records of every page as soon as it is written.
+    manifest_filename = f"{cache_dir}/manifest.json"
+    manifest = chunks.load_json(manifest_filename)
+
+    if manifest is None:
+        if windows is None:
+            total_results = fetch_total(url, params, start_time, end_time)
+        else:
+            total_results = sum(fetch_total(url, params, after, before) for after, before in windows)
+        pages = math.ceil(total_results / page_size)
+        print(f"Total Results: {total_results}")
+        print(f"Total Pages: {pages} pages")
+
+        shards = max(1, min(shards, pages))
+        if windows is None and shards == 1:
+            windows = [(start_time, end_time)]
+        elif windows is None:
+            windows = plan_windows(url, params, start_time, end_time, shards, workers)
+            print(f"Split into {len(windows)} windows")
+
+        manifest = {
+            "total_pages": pages,
+            "windows": [{"after": after, "before": before, "pages": 0, "done": False} for after, before in windows],
+            "done": False,
+        }
+        chunks.save_json(manifest_filename, manifest)
+    else:
+        print(f"Resuming from {manifest_filename}")
+
+    windows = manifest["windows"]
+    pages = manifest["total_pages"]
+    lock = threading.Lock()
+
+    def commit(window, **progress):
+        with lock:
+            window.update(progress)
+            chunks.save_json(manifest_filename, manifest)
+            fetched = sum(w["pages"] for w in windows)
+            metrics.progress("cache_pages", done=fetched, total=pages)
+            print(f"{fetched:5} / {pages} Fetched.", end="\r")
+
+    # a single window is written in place. shards are written to their own directories first and
+    # renumbered into one sequence afterwards, so the layout is the same as a serial crawl.
+    def shard_dir(shard):
+        return cache_dir if len(windows) == 1 else f"{cache_dir}/.shard{shard}"
+
+    def fetch(shard):
+        os.makedirs(shard_dir(shard), exist_ok=True)
+        fetch_window(url, params, windows[shard], shard_dir(shard), prefix, commit, on_page)
+
+    with ThreadPoolExecutor(max_workers=workers or len(windows)) as executor:
+        list(executor.map(fetch, range(len(windows))))
+
+    if len(windows) > 1:
+        # renaming is idempotent, so an interrupted merge simply runs again on resume
+        page_no = 1
+        for shard, window in enumerate(windows):
+            for page in range(1, window["pages"] + 1):
+                filename = chunks.chunk_filename(shard_dir(shard), f"{prefix}{page}")
+                if filename is not None:
+                    os.replace(filename, f"{cache_dir}/{prefix}{page_no}{chunks.split_extension(filename)[1]}")
+                page_no += 1
+            if os.path.exists(shard_dir(shard)):
+                os.rmdir(shard_dir(shard))
+
+    manifest["done"] = True
+    chunks.save_json(manifest_filename, manifest)
+
+def is_cached(cache_dir, prefix):
+    # directories with pages but without a manifest were cached before crawls became resumable.
+    # an empty one is left behind by a crawl that failed before its manifest was written.
+    if not os.path.exists(cache_dir):
+        return False
+
+    manifest = chunks.load_json(f"{cache_dir}/manifest.json")
+    if manifest is None:
+        return chunks.chunk_filename(cache_dir, f"{prefix}1") is not None
+    return manifest["done"]
+
+def cache_posts(keyword, after, before, subreddit, target_dir="./cache/pushshift", shards=1, workers=None, index=None):
     cache_dir = f"{target_dir}/{posts_dir}/{keyword}"
 
-    if os.path.exists(cache_dir):
+    if is_cached(cache_dir, "post"):
         return
 
-    os.makedirs(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
     start_time = int(datetime.strptime(after, '%Y-%m-%dT%H:%M:%S').timestamp())
     end_time = int(datetime.strptime(before, '%Y-%m-%dT%H:%M:%S').timestamp())
-    page_size = 250
 
-    url = "https://api.pushshift.io/reddit/search/submission"
     params = {
         "q": "" if keyword == "all" else keyword,
-        "after": start_time,
-        "before": end_time,
         "subreddit": subreddit,
         "sort": "asc",
         "sort_type": "created_utc",
@@ -38,51 +195,50 @@ def cache_posts(keyword, after, before, subreddit, target_dir="./cache/pushshift
         "metadata": "true"
     }
 
-    initial_response = requests.get(url, params=params)
-    response_json = initial_response.json()
-    total_results = response_json["metadata"]["total_results"]
-    pages = math.ceil(total_results / page_size)
-    with open(f"{cache_dir}/post1.json", "w") as f:
-        f.write(initial_response.text)
     print("----------- Started Caching Posts  -----------")
-
-    print(f"Total Results: {total_results} posts")
-    print(f"Total Pages: {pages} pages")
-
-    last_time = response_json["data"][-1]["created_utc"]
-    # we've already fetched page 1
-    for i in range(1, pages):
-        params = {
-            **params,
-            "after": last_time + 1,
-        }
-        response = requests.get(url, params=params)
-        response_json = response.json()
-        with open(f"{cache_dir}/post{i + 1}.json", "w") as f:
-            f.write(response.text)
-        last_time = response_json["data"][-1]["created_utc"]
-
-        print(f"{(i + 1):5} / {pages} Fetched.", end="\r")
-
+    if index is None:
+        cache_pages(submission_url, params, start_time, end_time, cache_dir, "post", shards, workers)
+    elif keyword == "all":
+        cache_pages(submission_url, params, start_time, end_time, cache_dir, "post", shards, workers)
+        # the whole directory is indexed once it is complete, so pages fetched by an earlier run without
+        # --index are in the index before the range is marked as covered. adding a post again is harmless.
+        search_index.index_chunks(index, "post", cache_dir, "post", subreddit, start_time, end_time)
+    else:
+        # only ranges no "all" crawl has covered go over the network, and pushshift's matches for them are
+        # kept as they are. only the covered ranges are matched locally.
+        # the unfinished manifest keeps an interrupted gap crawl from looking like a legacy cache.
+        chunks.save_json(f"{cache_dir}/manifest.json", {"total_pages": 0, "windows": [], "done": False})
+        gaps = index.uncovered("post", subreddit, start_time, end_time)
+        network_dir = f"{cache_dir}/.network"
+        fetched = []
+        if gaps:
+            print(f"{len(gaps)} ranges are not covered by the index")
+            os.makedirs(network_dir, exist_ok=True)
+            cache_pages(submission_url, params, start_time, end_time, network_dir, "post", shards, workers, windows=gaps, on_page=lambda posts: index.add("post", posts))
+            fetched = [post for _, filename in chunks.iter_chunks(network_dir, "post{}") for post in chunks.iter_records(filename)]
+
+        matched = [post for after, before in index.covered("post", subreddit, start_time, end_time) for post in index.search("post", keyword, subreddit, after, before)]
+        posts = list(heapq.merge(fetched, matched, key=lambda post: post["created_utc"]))
+        pages = search_index.write_chunks(posts, cache_dir, "post", page_size)
+        chunks.save_json(f"{cache_dir}/manifest.json", {"total_pages": pages, "windows": [], "done": True})
+        if os.path.exists(network_dir):
+            shutil.rmtree(network_dir)
+        print(f"{len(fetched)} posts fetched from pushshift, {len(matched)} served from the index")
     print("----------- Finished Caching Posts -----------")
     print(f"Cache directory is {cache_dir}", end="\n\n")
 
-def cache_comments(keyword, after, before, subreddit, target_dir="./cache/pushshift"):
+def cache_comments(keyword, after, before, subreddit, target_dir="./cache/pushshift", shards=1, workers=None):
     cache_dir = f"{target_dir}/{comments_dir}/{keyword}"
 
-    if os.path.exists(cache_dir):
+    if is_cached(cache_dir, "comment"):
         return
 
-    os.makedirs(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
     start_time = int(datetime.strptime(after, '%Y-%m-%dT%H:%M:%S').timestamp())
     end_time = int(datetime.strptime(before, '%Y-%m-%dT%H:%M:%S').timestamp())
-    page_size = 250
 
-    url = "https://api.pushshift.io/reddit/search/comment"
     params = {
         "q": keyword,
-        "after": start_time,
-        "before": end_time,
         "subreddit": subreddit,
         "sort": "asc",
         "sort_type": "created_utc",
@@ -90,32 +246,8 @@ def cache_comments(keyword, after, before, subreddit, target_dir="./cache/pushsh
         "metadata": "true"
     }
 
-    initial_response = requests.get(url, params=params)
-    response_json = initial_response.json()
-    total_results = response_json["metadata"]["total_results"]
-    pages = math.ceil(total_results / page_size)
-    with open(f"{cache_dir}/comment1.json", "w") as f:
-        f.write(initial_response.text)
     print("----------- Started Caching Comments  -----------")
-
-    print(f"Total Results: {total_results} comments")
-    print(f"Total Pages: {pages} pages")
-
-    last_time = response_json["data"][-1]["created_utc"]
-    # we've already fetched page 1
-    for i in range(1, pages):
-        params = {
-            **params,
-            "after": last_time + 1,
-        }
-        response = requests.get(url, params=params)
-        response_json = response.json()
-        with open(f"{cache_dir}/comment{i + 1}.json", "w") as f:
-            f.write(response.text)
-        last_time = response_json["data"][-1]["created_utc"]
-
-        print(f"{(i + 1):5} / {pages} Fetched.", end="\r")
-
+    cache_pages(comment_url, params, start_time, end_time, cache_dir, "comment", shards, workers)
     print("----------- Finished Caching Comments -----------")
     print(f"Cache directory is {cache_dir}", end="\n\n")
 
@@ -147,13 +279,9 @@ def process_posts(keyword="dao", target_dir="./cache/pushshift", output_dir="./r
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
         writer.writeheader()
 
-        post_no = 1
         index = 1
-        while os.path.exists(f"{cache_dir}/post{post_no}.json"):
-            with open(f"{cache_dir}/post{post_no}.json") as f:
-                data = json.loads(f.read())
-
-            for post in data["data"]:
+        for _, filename in chunks.iter_chunks(cache_dir, "post{}"):
+            for post in chunks.iter_records(filename):
                 contents = resolve_post_content(post)
                 writer.writerow({
                     "num_post": index,
@@ -167,8 +295,6 @@ def process_posts(keyword="dao", target_dir="./cache/pushshift", output_dir="./r
                 })
                 index += 1
 
-            post_no += 1
-
     print(f"Finished processing posts. Results are at {output_dir}/{keyword}-posts.csv")
 
 def process_comments(keyword, target_dir="./cache/pushshift", output_dir="./results"):
@@ -182,13 +308,9 @@ def process_comments(keyword, target_dir="./cache/pushshift", output_dir="./resu
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
         writer.writeheader()
 
-        comment_no = 1
         index = 1
-        while os.path.exists(f"{cache_dir}/comment{comment_no}.json"):
-            with open(f"{cache_dir}/comment{comment_no}.json") as f:
-                data = json.loads(f.read())
-
-            for comment in data["data"]:
+        for _, filename in chunks.iter_chunks(cache_dir, "comment{}"):
+            for comment in chunks.iter_records(filename):
                 post_id = comment["link_id"][3:]
                 # there are some comments that do not contain "nest_level". In that case compare the link id with the parent id.
                 is_reply = comment["nest_level"] > 1 if "nest_level" in comment else comment["link_id"] == comment["parent_id"]
@@ -206,8 +328,6 @@ def process_comments(keyword, target_dir="./cache/pushshift", output_dir="./resu
                 })
                 index += 1
 
-            comment_no += 1
-
     print(f"Finished processing comments. Results are at {output_dir}/{keyword}-comments.csv")
 
 if __name__ == "__main__":
@@ -226,29 +346,50 @@ if __name__ == "__main__":
         type=lambda s: f'{s}T23:59:59'
     )
     parser.add_argument("--subreddit", help='Which subreddit to search posts or comments from. ex> "ethereum"', default="ethereum")
+    parser.add_argument("--shards", help='Split the date range into this many time windows and page through them concurrently. 1 by default', type=int, default=1)
+    parser.add_argument("--workers", help='Maximum number of windows fetched at the same time. Same as --shards by default', type=int)
+    parser.add_argument("--store", help='Also add the cached posts to the post store shared by every keyword. A .db file is a sqlite store. ex> ./cache/store or ./cache/store.db')
+    parser.add_argument("--index", help='Answer keyword searches from a local index where an "all" crawl already covers the range, and add every crawled post to it. ex> ./cache/index.db')
+    parser.add_argument("--rate", help='Maximum number of requests per second sent to pushshift. 1 by default', type=float, default=1.0)
+    parser.add_argument("--compress", help='Compress cached pages. zstd needs the zstandard package. Uncompressed by default', choices=chunks.compression_suffixes.keys())
+    parser.add_argument("--drop-fields", help='Fields left out of cached posts and comments. ex> body_html selftext_html', nargs="+", default=[])
+    parser.add_argument("--metrics-file", help='Write request latencies, retries, throttling and progress to this file every --metrics-interval seconds. A .prom file gets the Prometheus text format, anything else json. ex> ./metrics/pushshift.prom')
+    parser.add_argument("--metrics-interval", help='Seconds between metrics exports. 10 by default', type=float, default=10.0)
 
     args = parser.parse_args()
     keyword = args.keyword
-
-    subreddit = args.subreddit
-    if args.cache != "none":
-        if args.after is None:
-            print("The --after option must be specified for --cache", file=sys.stderr)
-        if args.before is None:
-            print("The --before option must be specified for --cache", file=sys.stderr)
-
-    if args.cache == "both":
-        cache_posts(keyword, args.after, args.before, subreddit)
-        cache_comments(keyword, args.after, args.before, subreddit)
-    elif args.cache == "post":
-        cache_posts(keyword, args.after, args.before, subreddit)
-    elif args.cache == "comment":
-        cache_comments(keyword, args.after, args.before, subreddit)
-
-    if args.process == "both":
-        process_posts(keyword)
-        process_comments(keyword)
-    elif args.process == "post":
-        process_posts(keyword)
-    elif args.process == "comment":
-        process_comments(keyword)
+    chunks.configure(args.compress, args.drop_fields)
+    exporter = metrics.start_export(args.metrics_file, args.metrics_interval)
+    http_client.configure(rate=args.rate, default_concurrency=max(args.shards, args.workers or 0, 1))
+
+    try:
+        subreddit = args.subreddit
+        if args.cache != "none":
+            if args.after is None:
+                print("The --after option must be specified for --cache", file=sys.stderr)
+            if args.before is None:
+                print("The --before option must be specified for --cache", file=sys.stderr)
+
+        index = None if args.index is None else search_index.SearchIndex(args.index)
+        if args.cache == "both":
+            cache_posts(keyword, args.after, args.before, subreddit, shards=args.shards, workers=args.workers, index=index)
+            cache_comments(keyword, args.after, args.before, subreddit, shards=args.shards, workers=args.workers)
+        elif args.cache == "post":
+            cache_posts(keyword, args.after, args.before, subreddit, shards=args.shards, workers=args.workers, index=index)
+        elif args.cache == "comment":
+            cache_comments(keyword, args.after, args.before, subreddit, shards=args.shards, workers=args.workers)
+
+        if args.store is not None and args.cache in ("both", "post"):
+            count = import_posts(open_store(args.store), keyword, f"./cache/pushshift/{posts_dir}/{keyword}")
+            print(f"Added {count} posts to {args.store} under {keyword}")
+
+        if args.process == "both":
+            process_posts(keyword)
+            process_comments(keyword)
+        elif args.process == "post":
+            process_posts(keyword)
+        elif args.process == "comment":
+            process_comments(keyword)
+    finally:
+        if exporter is not None:
+            exporter.stop()
@@ -0,0 +1,110 @@
+import contextlib
+import queue
+import time
+from urllib.parse import urlparse
+
+import praw
+import prawcore
+from prawcore.rate_limit import RateLimiter
+from prawcore.sessions import FiniteRetryStrategy
+
+import metrics
+from http_client import TokenBucket
+
+# About User Agent Naming Convention: https://github.com/reddit-archive/reddit/wiki/API
+user_agent = "python3:ethereum-dao-search:v1.0 (by /u/pacokwon)"
+
+# reddit allows 100 requests per minute for every OAuth client id
+site_rate = 100 / 60
+
+def reddit_endpoint(url):
+    # "/api/info" stays as is, but "/comments/<id>/..." becomes "/comments" so ids don't become labels
+    path = urlparse(url).path
+    path = path[:-5] if path.endswith(".json") else path
+    if path.startswith("/api/"):
+        return path
+    return "/" + path.strip("/").split("/")[0]
+
+class BudgetedRequestor(prawcore.Requestor):
+    # a prawcore requestor that takes a token from every bucket before each request.
+    # PRAW only knows about the quota of its own instance, so instances that share a
+    # credential or a global budget have to be throttled here.
+    def __init__(self, *args, buckets=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = reddit_endpoint(url)
+        for bucket in self.buckets:
+            metrics.inc("rate_limit_wait_seconds_total", bucket.acquire(), endpoint=endpoint)
+
+        started = time.monotonic()
+        response = super().request(method, url, *args, **kwargs)
+        metrics.observe("http_request_seconds", time.monotonic() - started, endpoint=endpoint)
+        metrics.inc("http_responses_total", endpoint=endpoint, status=response.status_code)
+        metrics.inc("http_received_bytes_total", len(response.content), endpoint=endpoint)
+        return response
+
+class MeteredRateLimiter(RateLimiter):
+    # prawcore sleeps before each request to stay under the quota reddit reports in its headers.
+    # the sleep happens before the requestor is called, so it is timed here.
+    def call(self, request_function, set_header_callback, method, url, *args, **kwargs):
+        started = time.monotonic()
+        self.delay()
+        metrics.inc("praw_rate_limit_wait_seconds_total", time.monotonic() - started, endpoint=reddit_endpoint(url))
+        # the delay is over, so the one in call returns at once
+        return super().call(request_function, set_header_callback, method, url, *args, **kwargs)
+
+class MeteredRetryStrategy(FiniteRetryStrategy):
+    # prawcore retries 5xx responses and connection errors itself, sleeping before every retry
+    def sleep(self):
+        seconds = self._sleep_seconds()
+        if seconds is not None:
+            metrics.inc("praw_retries_total")
+            metrics.inc("praw_retry_wait_seconds_total", seconds)
+            time.sleep(seconds)
+
+def meter_sessions(reddit):
+    # swap the rate limiter and retry strategy of every prawcore session of a fresh praw.Reddit
+    for session in (reddit._read_only_core, reddit._authorized_core):
+        if session is not None:
+            session._rate_limiter = MeteredRateLimiter(window_size=session._rate_limiter.window_size)
+            session._retry_strategy_class = MeteredRetryStrategy
+    return reddit
+
+class RedditPool:
+    # PRAW instances are not thread safe, so every worker borrows one for the duration of a submission
+    def __init__(self, reddits):
+        self.reddits = list(reddits)
+        self.idle = queue.Queue()
+        for reddit in self.reddits:
+            self.idle.put(reddit)
+
+    def __len__(self):
+        return len(self.reddits)
+
+    @contextlib.contextmanager
+    def borrow(self):
+        reddit = self.idle.get()
+        try:
+            yield reddit
+        finally:
+            self.idle.put(reddit)
+
+def make_reddit_pool(sites, workers=1, rate=None, per_site_rate=site_rate):
+    # workers are spread over the praw.ini sites round robin. workers on the same site share
+    # that site's quota, and every worker shares the global `rate` if one is given.
+    global_buckets = () if rate is None else (TokenBucket(rate),)
+    site_buckets = {site: TokenBucket(per_site_rate) for site in sites}
+
+    reddits = []
+    for worker in range(max(1, workers)):
+        site = sites[worker % len(sites)]
+        reddits.append(meter_sessions(praw.Reddit(
+            site,
+            user_agent=user_agent,
+            requestor_class=BudgetedRequestor,
+            requestor_kwargs={"buckets": (*global_buckets, site_buckets[site])},
+        )))
+
+    return RedditPool(reddits)
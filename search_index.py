@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import os.path
+import re
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+
+import chunks
+
+# the fields pushshift searches with "q"
+searched_fields = {"post": ("title", "selftext"), "comment": ("body",)}
+
+def tokenize(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+class SearchIndex:
+    # an inverted index over the cached posts and comments, kept in a sqlite file. it also remembers
+    # which (subreddit, time range) pairs were crawled without a keyword. any keyword query inside those
+    # ranges can then be answered from disk, and only the ranges outside them need pushshift.
+    schema = """
+        create table if not exists docs (id text, kind text, subreddit text, created_utc integer, data text not null, primary key (kind, id));
+        create table if not exists postings (term text, kind text, id text, primary key (term, kind, id)) without rowid;
+        create table if not exists coverage (kind text, subreddit text, after integer, before integer);
+        create index if not exists docs_subreddit_created_utc on docs (kind, subreddit, created_utc);
+    """
+
+    def __init__(self, filename):
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        # pages of concurrent shards are added from several threads
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("pragma journal_mode = wal")
+            self.db.executescript(self.schema)
+
+    def add(self, kind, records):
+        docs = []
+        postings = []
+        for record in records:
+            docs.append((record["id"], kind, record.get("subreddit", "").lower(), record["created_utc"], json.dumps(record, ensure_ascii=False)))
+            terms = set()
+            for field in searched_fields[kind]:
+                terms |= tokenize(record.get(field) or "")
+            postings.extend((term, kind, record["id"]) for term in terms)
+
+        with self.lock, self.db:
+            self.db.executemany("insert or replace into docs values (?, ?, ?, ?, ?)", docs)
+            self.db.executemany("insert or ignore into postings values (?, ?, ?)", postings)
+
+    def add_coverage(self, kind, subreddit, after, before):
+        with self.lock, self.db:
+            self.db.execute("insert into coverage values (?, ?, ?, ?)", (kind, subreddit.lower(), after, before))
+
+    def uncovered(self, kind, subreddit, after, before):
+        # the parts of (after, before) that were never crawled without a keyword. bounds are exclusive,
+        # like pushshift's, so ranges are compared as the inclusive seconds they contain.
+        with self.lock:
+            ranges = self.db.execute(
+                "select after + 1, before - 1 from coverage where kind = ? and subreddit = ? order by after",
+                (kind, subreddit.lower()),
+            ).fetchall()
+
+        gaps = []
+        start, end = after + 1, before - 1
+        for covered_start, covered_end in ranges:
+            if covered_end < start:
+                continue
+            if covered_start > end:
+                break
+            if covered_start > start:
+                gaps.append((start - 1, covered_start))
+            start = max(start, covered_end + 1)
+        if start <= end:
+            gaps.append((start - 1, end + 1))
+
+        return gaps
+
+    def covered(self, kind, subreddit, after, before):
+        # the parts of (after, before) between the uncovered gaps, as exclusive ranges
+        ranges = []
+        start = after + 1
+        for gap_after, gap_before in self.uncovered(kind, subreddit, after, before):
+            if start <= gap_after:
+                ranges.append((start - 1, gap_after + 1))
+            start = gap_before
+        if start <= before - 1:
+            ranges.append((start - 1, before))
+
+        return ranges
+
+    def search(self, kind, keyword, subreddit, after, before):
+        # records of `kind` containing every word of `keyword`, created in (after, before), oldest first
+        terms = sorted(tokenize(keyword))
+        matching = " intersect ".join("select id from postings where term = ? and kind = ?" for _ in terms)
+        query = "select data from docs where kind = ? and subreddit = ? and created_utc > ? and created_utc < ?"
+        if terms:
+            query += f" and id in ({matching})"
+        query += " order by created_utc, id"
+
+        parameters = [kind, subreddit.lower(), after, before]
+        for term in terms:
+            parameters += [term, kind]
+
+        with self.lock:
+            rows = self.db.execute(query, parameters).fetchall()
+        return [json.loads(data) for data, in rows]
+
+def write_chunks(records, cache_dir, prefix, page_size=250):
+    # the same post{N}.json layout pushshift.py writes
+    os.makedirs(cache_dir, exist_ok=True)
+    pages = 0
+    for start in range(0, len(records), page_size):
+        pages += 1
+        chunks.write_records(chunks.compressed(f"{cache_dir}/{prefix}{pages}.json"), records[start:start + page_size], {"data": []})
+    return pages
+
+def index_chunks(index, kind, cache_dir, prefix, subreddit=None, after=None, before=None):
+    # add an existing cache directory. when it was crawled without a keyword, pass its subreddit and
+    # range to mark them as covered.
+    count = 0
+    for _, filename in chunks.iter_chunks(cache_dir, prefix + "{}"):
+        records = list(chunks.iter_records(filename))
+        index.add(kind, records)
+        count += len(records)
+
+    if subreddit is not None:
+        index.add_coverage(kind, subreddit, after, before)
+
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", help='The index file. ./cache/index.db by default', default="./cache/index.db")
+    parser.add_argument("--posts-dir", help='Add posts cached by pushshift.py to the index. ex> ./cache/pushshift/posts/all')
+    parser.add_argument("--comments-dir", help='Add comments cached by pushshift.py to the index. ex> ./cache/pushshift/comments/all')
+    parser.add_argument("--subreddit", help='Mark the range as covered for this subreddit. Only pass this for directories cached with the "all" keyword')
+    parser.add_argument("--after", help='Start of the covered range. format> 2016-01-01', type=lambda s: int(datetime.strptime(s, '%Y-%m-%d').timestamp()))
+    parser.add_argument("--before", help='End of the covered range. format> 2018-12-31', type=lambda s: int(datetime.strptime(f'{s}T23:59:59', '%Y-%m-%dT%H:%M:%S').timestamp()))
+    args = parser.parse_args()
+
+    if args.subreddit is not None and (args.after is None or args.before is None):
+        print("The --after and --before options must be specified for --subreddit", file=sys.stderr)
+        sys.exit(1)
+
+    index = SearchIndex(args.index)
+    if args.posts_dir is not None:
+        print(f"Indexed {index_chunks(index, 'post', args.posts_dir, 'post', args.subreddit, args.after, args.before)} posts")
+    if args.comments_dir is not None:
+        print(f"Indexed {index_chunks(index, 'comment', args.comments_dir, 'comment', args.subreddit, args.after, args.before)} comments")
@@ -0,0 +1,234 @@
+import argparse
+import collections
+import contextlib
+import json
+import os
+import os.path
+import sqlite3
+import threading
+
+import chunks
+
+class FileStore:
+    # posts and their comments keyed by submission id, shared by every keyword:
+    #   <root>/posts/<id[:2]>/<id>.json         the post
+    #   <root>/comments/<id[:2]>/<id>.jsonl     its comments, once they are crawled
+    #   <root>/keywords/<keyword>.json          ids of the posts matching the keyword, in pushshift's order
+    # a post that matches several keywords is stored, and its comments crawled, only once.
+    def __init__(self, root="./cache/store"):
+        self.root = root
+        for dirname in ("posts", "comments", "keywords"):
+            os.makedirs(f"{root}/{dirname}", exist_ok=True)
+
+    def path(self, kind, post_id, extension):
+        return f"{self.root}/{kind}/{post_id[:2]}/{post_id}{extension}"
+
+    def put_posts(self, posts):
+        for post in posts:
+            # a post we already have may carry what the crawler added to it, ex> refreshed scores
+            filename = self.path("posts", post["id"], ".json")
+            if os.path.exists(filename):
+                continue
+
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            chunks.write_atomic(filename, json.dumps(post, ensure_ascii=False))
+
+    def get_post(self, post_id):
+        return chunks.load_json(self.path("posts", post_id, ".json"))
+
+    def has_comments(self, post_id):
+        return os.path.exists(self.path("comments", post_id, ".jsonl"))
+
+    def put_comments(self, post, comments):
+        # comments first, so the updated post never claims comments that aren't stored
+        filename = self.path("comments", post["id"], ".jsonl")
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        chunks.write_records(filename, comments)
+        chunks.write_atomic(self.path("posts", post["id"], ".json"), json.dumps(post, ensure_ascii=False))
+
+    def get_comments(self, post_id):
+        return list(chunks.iter_records(self.path("comments", post_id, ".jsonl")))
+
+    def add_keyword(self, keyword, ids):
+        filename = f"{self.root}/keywords/{keyword}.json"
+        listed = chunks.load_json(filename, [])
+        seen = set(listed)
+        listed.extend(post_id for post_id in ids if post_id not in seen and not seen.add(post_id))
+        chunks.save_json(filename, listed)
+
+    def keyword_ids(self, keyword):
+        return chunks.load_json(f"{self.root}/keywords/{keyword}.json", [])
+
+    def iter_keyword(self, keyword):
+        # yields (post, comments) for every crawled post of the keyword
+        for post_id in self.keyword_ids(keyword):
+            if self.has_comments(post_id):
+                yield self.get_post(post_id), self.get_comments(post_id)
+
+class SqliteStore:
+    # the same store in a single sqlite file, indexed by id, created_utc, link_id and parent_id.
+    # every write is a single transaction, and reads are streamed from cursors.
+    schema = """
+        create table if not exists posts (id text primary key, created_utc integer, subreddit text, data text not null);
+        create table if not exists comments (id text primary key, link_id text not null, parent_id text, created_utc integer, data text not null);
+        create table if not exists crawled (post_id text primary key);
+        create table if not exists keywords (keyword text, position integer, post_id text, primary key (keyword, post_id));
+        create index if not exists posts_created_utc on posts (created_utc);
+        create index if not exists comments_link_id on comments (link_id);
+        create index if not exists comments_parent_id on comments (parent_id);
+        create index if not exists comments_created_utc on comments (created_utc);
+        create index if not exists keywords_position on keywords (keyword, position);
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.root = os.path.dirname(filename) or "."
+        os.makedirs(self.root, exist_ok=True)
+        # crawler threads share the connection, one statement at a time
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("pragma journal_mode = wal")
+            self.db.executescript(self.schema)
+
+    def put_posts(self, posts):
+        rows = [(post["id"], post["created_utc"], post.get("subreddit"), json.dumps(post, ensure_ascii=False)) for post in posts]
+        with self.lock, self.db:
+            self.db.executemany("insert or ignore into posts values (?, ?, ?, ?)", rows)
+
+    def get_post(self, post_id):
+        with self.lock:
+            row = self.db.execute("select data from posts where id = ?", (post_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def has_comments(self, post_id):
+        with self.lock:
+            return self.db.execute("select 1 from crawled where post_id = ?", (post_id,)).fetchone() is not None
+
+    def put_comments(self, post, comments):
+        rows = [(comment["id"], comment["link_id"], comment["parent_id"], comment["created_utc"], json.dumps(comment, ensure_ascii=False)) for comment in comments]
+        with self.lock, self.db:
+            self.db.execute("delete from comments where link_id = ?", (f"t3_{post['id']}",))
+            self.db.executemany("insert or replace into comments values (?, ?, ?, ?, ?)", rows)
+            self.db.execute("insert or replace into posts values (?, ?, ?, ?)", (post["id"], post["created_utc"], post.get("subreddit"), json.dumps(post, ensure_ascii=False)))
+            self.db.execute("insert or ignore into crawled values (?)", (post["id"],))
+
+    def get_comments(self, post_id):
+        with self.lock:
+            rows = self.db.execute("select data from comments where link_id = ? order by rowid", (f"t3_{post_id}",)).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def add_keyword(self, keyword, ids):
+        with self.lock, self.db:
+            position = self.db.execute("select coalesce(max(position), 0) from keywords where keyword = ?", (keyword,)).fetchone()[0]
+            self.db.executemany(
+                "insert or ignore into keywords values (?, ?, ?)",
+                ((keyword, position + n, post_id) for n, post_id in enumerate(ids, 1)),
+            )
+
+    def keyword_ids(self, keyword):
+        with self.lock:
+            rows = self.db.execute("select post_id from keywords where keyword = ? order by position", (keyword,)).fetchall()
+        return [post_id for post_id, in rows]
+
+    def iter_keyword(self, keyword):
+        # a separate connection, so a long export doesn't hold the lock the crawler threads need.
+        # it is closed even when the caller stops early.
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            posts = db.execute(
+                "select posts.id, posts.data from keywords join posts on posts.id = keywords.post_id"
+                " join crawled on crawled.post_id = posts.id where keyword = ? order by position",
+                (keyword,),
+            )
+            for post_id, data in posts:
+                comments = db.execute("select data from comments where link_id = ? order by rowid", (f"t3_{post_id}",))
+                yield json.loads(data), [json.loads(comment) for comment, in comments]
+
+    def iter_posts(self, after=None, before=None):
+        # posts created in (after, before), oldest first
+        with contextlib.closing(sqlite3.connect(self.filename)) as db:
+            for data, in db.execute(
+                "select data from posts where created_utc > ? and created_utc < ? order by created_utc",
+                (after if after is not None else -1, before if before is not None else 2 ** 62),
+            ):
+                yield json.loads(data)
+
+def open_store(path):
+    # a path to a .db or .sqlite file opens the sqlite store, anything else the file store
+    if path.endswith((".db", ".sqlite")):
+        return SqliteStore(path)
+    return FileStore(path)
+
+def import_comments(store, keyword, posts_dir, comments_dir):
+    # add crawled chunks to the store, under `keyword`. posts and their threads line up in chunk order.
+    count = 0
+    for post_no, filename in chunks.iter_chunks(posts_dir, "updated_post{}"):
+        comment_filename = chunks.chunk_filename(comments_dir, f"post{post_no}_comment")
+        if comment_filename is None:
+            break
+
+        threads = collections.defaultdict(list)
+        for comment in chunks.iter_records(comment_filename):
+            threads[comment["link_id"][3:]].append(comment)
+        posts = list(chunks.iter_records(filename))
+        for post in posts:
+            store.put_comments(post, threads[post["id"]])
+        store.add_keyword(keyword, [post["id"] for post in posts])
+        count += len(posts)
+
+    return count
+
+def export_chunks(store, keyword, posts_dir, comments_dir, chunk_size=250):
+    # write a keyword back out in the updated_post{N}.json / post{N}_comment.json layout
+    os.makedirs(posts_dir, exist_ok=True)
+    os.makedirs(comments_dir, exist_ok=True)
+    posts, comments = [], []
+    post_no = 0
+
+    def flush():
+        nonlocal posts, comments, post_no
+        post_no += 1
+        chunks.write_records(chunks.compressed(f"{posts_dir}/updated_post{post_no}.json"), posts, {"data": []})
+        chunks.write_records(chunks.compressed(f"{comments_dir}/post{post_no}_comment.json"), comments)
+        posts, comments = [], []
+
+    for post, thread in store.iter_keyword(keyword):
+        posts.append(post)
+        comments.extend(thread)
+        if len(posts) == chunk_size:
+            flush()
+    if posts:
+        flush()
+
+    return post_no
+
+def import_posts(store, keyword, posts_dir):
+    # add the pages cached by pushshift.py to the store, under `keyword`
+    ids = []
+    for _, filename in chunks.iter_chunks(posts_dir, "post{}"):
+        posts = list(chunks.iter_records(filename))
+        store.put_posts(posts)
+        ids.extend(post["id"] for post in posts)
+    store.add_keyword(keyword, ids)
+    return len(ids)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", help='Supported values: "import" | "export" (without double quotes)', choices=["import", "export"])
+    parser.add_argument("--store", help='The store to import into or export from. A .db file is a sqlite store. ex> ./cache/store.db', required=True)
+    parser.add_argument("--keyword", help='Which keyword to import or export. ex> dao', required=True)
+    parser.add_argument("--posts-dir", help='Where posts are cached at. ex> ./cache/pushshift/posts/dao', required=True)
+    parser.add_argument("--comments-dir", help='Where comments are cached at. ex> ./cache/praw/comments/dao')
+    parser.add_argument("--compress", help='Compress exported chunks. zstd needs the zstandard package. Uncompressed by default', choices=chunks.compression_suffixes.keys())
+    args = parser.parse_args()
+    chunks.configure(args.compress)
+
+    store = open_store(args.store)
+    if args.command == "import":
+        print(f"Imported {import_posts(store, args.keyword, args.posts_dir)} posts")
+        if args.comments_dir is not None:
+            print(f"Imported comments of {import_comments(store, args.keyword, args.posts_dir, args.comments_dir)} posts")
+    else:
+        if args.comments_dir is None:
+            parser.error("--comments-dir is required for export")
+        print(f"Exported {export_chunks(store, args.keyword, args.posts_dir, args.comments_dir)} chunks")
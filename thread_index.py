@@ -0,0 +1,69 @@
+import collections
+
+class ThreadIndex:
+    # structure of the comment tree of one submission, built iteratively in linear time, so that
+    # arbitrarily deep reply chains can't hit the recursion limit. for every comment id it holds:
+    #   depth    0 for top level comments
+    #   root     id of the top level comment the comment belongs to
+    #   replies  number of direct replies
+    #   size     number of comments in the subtree, including the comment itself
+    #   score    sum of the scores in the subtree
+    # comments whose parent is not in the data (removed, or crawled in another chunk) are
+    # treated as top level comments and listed in `orphans`.
+    def __init__(self, comments):
+        self.parent = dict()
+        scores = dict()
+        for comment in comments:
+            parent_id = comment["parent_id"]
+            self.parent[comment["id"]] = None if parent_id[1] == "3" else parent_id[3:]
+            scores[comment["id"]] = comment.get("score") or 0
+
+        self.orphans = set()
+        children = collections.defaultdict(list)
+        for comment_id, parent_id in self.parent.items():
+            if parent_id is not None and parent_id not in self.parent:
+                self.orphans.add(comment_id)
+                self.parent[comment_id] = None
+            elif parent_id is not None:
+                children[parent_id].append(comment_id)
+
+        self.depth = dict()
+        self.root = dict()
+        order = []
+
+        def walk(top):
+            # breadth first from `top`, so parents are always visited before their replies
+            self.depth[top] = 0
+            self.root[top] = top
+            queue = collections.deque([top])
+            while queue:
+                comment_id = queue.popleft()
+                order.append(comment_id)
+                for child in children[comment_id]:
+                    if child in self.depth:
+                        continue
+                    self.depth[child] = self.depth[comment_id] + 1
+                    self.root[child] = self.root[comment_id]
+                    queue.append(child)
+
+        for comment_id, parent_id in self.parent.items():
+            if parent_id is None:
+                walk(comment_id)
+
+        # whatever wasn't reached hangs off a cycle in broken data. cut it at an arbitrary comment.
+        for comment_id in self.parent:
+            if comment_id not in self.depth:
+                children[self.parent[comment_id]].remove(comment_id)
+                self.orphans.add(comment_id)
+                self.parent[comment_id] = None
+                walk(comment_id)
+
+        self.replies = {comment_id: len(children[comment_id]) for comment_id in self.parent}
+        self.size = dict.fromkeys(self.parent, 1)
+        self.score = dict(scores)
+        # replies come after their parents in `order`, so walking it backwards folds every subtree up
+        for comment_id in reversed(order):
+            parent_id = self.parent[comment_id]
+            if parent_id is not None:
+                self.size[parent_id] += self.size[comment_id]
+                self.score[parent_id] += self.score[comment_id]